@@ -1,13 +1,121 @@
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, g, request, abort, jsonify, \
+    stream_with_context
 
 from flask_cors import CORS
-from backend.database.models import Catalog, Renter, Rented, setup_db
-from backend.auth.auth import AuthError, requires_auth
+from backend.database.models import Catalog, Renter, Report, \
+    select_fields, setup_db
+from backend.auth.auth import AuthError, check_permissions, requires_auth
+from backend.auth.keys import get_key_provider
+from backend.auth.ratelimit import RateLimit, RateLimitError
 from backend.database.models import database_path
+from backend.database.events import EVENTS_MAX_WAIT, catalog_version, \
+    stream_events, wait_for_events
+from backend.database.shards import load_shard_map, setup_shards, \
+    shard_for, use_shard
+from backend.cache.response import ResponseCache
+from backend.cache.shared import shared_cache
+from backend.jobs.queue import JobQueue
+from backend.jobs.reports import build_invoice, build_rented, \
+    parse_datetime, rentals_version
+from backend.middleware.coalesce import SingleFlight
+from backend.middleware.compression import setup_compression
+from backend.middleware.idempotency import idempotent
+from backend.middleware.access_log import log_exception, setup_logging
+from backend.middleware.profiling import setup_profiling
 
 app = Flask(__name__)
 setup_db(app, database_path)
+setup_shards(app, load_shard_map())
+setup_compression(app)
+setup_profiling(app)
+setup_logging(app)
 CORS(app)
+# Fails at startup rather than on every request when misconfigured
+get_key_provider()
+
+# Page and request size limits of the renter routes
+MAX_PAGE_SIZE = 1000
+MAX_BULK_SIZE = 10000
+
+# Cached /plants responses, valid until the next plant event of the tenant
+# and cleared on every catalog write. Set SHARED_CACHE_DIR to share them
+# between the gunicorn workers
+catalog_cache = ResponseCache(version=catalog_version,
+                              shared=shared_cache('catalog'),
+                              params=('fields',))
+
+# Cached invoices, valid until the next rental event of the tenant
+invoice_cache = ResponseCache(version=rentals_version, params=('from', 'to'))
+
+# Identical concurrent GETs share one database query
+single_flight = SingleFlight()
+
+# Reports computed on the background worker pool
+jobs = JobQueue(app)
+jobs.register('invoice', build_invoice)
+jobs.register('rented', build_rented)
+
+
+@app.before_request
+def route_tenant():
+    """Routes public requests to the shard named by the optional X-Tenant
+    header. Authenticated routes use the JWT tenant claim instead
+    """
+    try:
+        use_shard(shard_for(app, request.headers.get('X-Tenant')))
+    except KeyError:
+        abort(404)
+
+
+def get_fields(allowed, default):
+    """Reads the optional comma separated 'fields' query parameter
+    (i.e. '?fields=name,price'). The 'id' field is always included
+    :param allowed: field names the caller may ask for
+    :param default: field names returned without the parameter
+    :return: tuple of field names, aborts with 422 for unknown fields
+    """
+    requested = request.args.get('fields')
+    if not requested:
+        return default
+
+    fields = ['id'] + [field.strip() for field in requested.split(',')
+                       if field.strip()]
+    if any(field not in allowed for field in fields):
+        abort(422)
+
+    return tuple(dict.fromkeys(fields))
+
+
+def get_if_match():
+    """Reads the versions from the optional If-Match header, a list of ETags.
+    '*' matches any existing version. If-Match compares strongly, so weak
+    ETags (W/"3") never match, aborts with 409 when only those are given
+    :return: list of integer version_ids or None, aborts with 422 when
+    malformed
+    """
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+
+    tags = if_match.as_set()
+    if not tags:
+        abort(409)
+
+    try:
+        return sorted(int(tag) for tag in tags)
+    except ValueError:
+        abort(422)
+
+
+def get_period():
+    """Reads the optional 'from' & 'to' ISO 8601 query parameters
+    :return: tuple of datetimes (or None), aborts with 422 when malformed
+    """
+    try:
+        return (parse_datetime(request.args.get('from') or None),
+                parse_datetime(request.args.get('to') or None))
+    except ValueError:
+        abort(422)
 
 
 # ----------------------------------------------------------------------------
@@ -16,15 +124,20 @@ CORS(app)
 
 @app.route('/')
 @app.route('/plants')
+@catalog_cache.cached
+@single_flight.coalesce
 def get_plants():
-    """A list of all available plants
+    """A list of all available plants. Only the columns named by the
+    optional 'fields' query parameter are selected
     :return: JSON with keys: 'success', 'message' & 'plants'
     """
+    fields = get_fields(Catalog.LONG_FIELDS, Catalog.SHORT_FIELDS)
+
     try:
-        results = Catalog.query.all()
+        results = select_fields(Catalog, fields).all()
 
         if results:
-            plants = [plant.short() for plant in results]
+            plants = [plant._asdict() for plant in results]
 
             return jsonify({
                 'success': True,
@@ -38,151 +151,296 @@ def get_plants():
             'plants': None
         })
     except Exception as e:
-        print(str(e))
+        log_exception(e)
         abort(404)
 
 
 @app.route('/plants/<int:plant_id>')
+@catalog_cache.cached
+@single_flight.coalesce
 def get_plants_by_id(plant_id):
-    """View selected plant by given id
+    """View selected plant by given id, limited to the columns named by the
+    optional 'fields' query parameter
     :return: JSON with keys: 'success', 'message' & 'plants'
     """
+    fields = get_fields(Catalog.LONG_FIELDS, Catalog.LONG_FIELDS)
+
     try:
-        results = Catalog.query.get_or_404(plant_id)
+        results = select_fields(Catalog, fields + ('version_id',)) \
+            .filter(Catalog.id == plant_id).first_or_404()
+        plant = results._asdict()
+        version = plant.pop('version_id')
 
         return jsonify({
             'success': True,
-            'plants': results.long(),
+            'plants': plant,
             'message': 'Enjoy this wonderful plant'
-        })
+        }), 200, {'ETag': f'"{version}"'}
     except Exception as e:
+        log_exception(e)
         abort(404)
 
 
 @app.route('/invoice/<int:renter_id>')
-@requires_auth('get:invoice')
+@requires_auth('get:invoice', limit=RateLimit())
+@invoice_cache.cached
+@single_flight.coalesce
 def get_renter_invoice(jwt, renter_id):
-    """View current invoice for the specified renter
+    """View current invoice for the specified renter, or the invoice of the
+    rentals active in the period given by the 'from' & 'to' query parameters.
+    Invoices use the prices the plants were rented at
     :return: JSON with keys 'success', 'invoice' & 'total'
     """
-    try:
-        results = Rented.query.filter_by(renter_id=renter_id).all()
+    start, end = get_period()
 
-        if not results:
-            return jsonify({
-                'success': True,
-                'invoice': None,
-                'total': 0.0
-            })
-
-        # Build the invoice
-        invoice = {}
-        total = 0.0
-
-        for rental in results:
-            plant_name = rental.Catalog.long()['name']
-            plant_price = rental.Catalog.long()['price']
-
-            total += plant_price
-
-            if plant_name not in invoice:
-                entry = {
-                    'count': 1,
-                    'price': plant_price
-                }
-                invoice[plant_name] = entry
-            else:
-                invoice[plant_name]['count'] += 1
-                invoice[plant_name]['price'] += plant_price
+    try:
+        report = build_invoice(renter_id, start, end)
 
         return jsonify({
             'success': True,
-            'invoice': invoice,
-            'total': total
+            'invoice': report['invoice'],
+            'total': report['total']
         })
     except Exception as e:
+        log_exception(e)
         abort(404)
 
 
 @app.route('/rented')
-@requires_auth('get:rented')
+@requires_auth('get:rented',
+               limit=RateLimit(rate=1, burst=5, concurrency=4))
+@single_flight.coalesce
 def get_rented_plants(jwt):
-    """A list of all rented plants and who rented them
+    """A list of all currently rented plants and who rented them
     :return: JSON with keys 'success', 'message' & 'data'
     """
     try:
-        results = Rented.query.all()
-        data = {}
+        report = build_rented()
 
-        if not results:
+        if not report['data']:
             return jsonify({
                 'success': True,
                 'message': 'Get some clients',
                 'data': None
             })
 
-        for entry in results:
-            client_name = entry.Renter.name
-            plant_name = entry.Catalog.name
-            plant_price = entry.Catalog.price
-
-            # New client entry
-            if client_name not in data:
-                # Make dict for this clients plants
-                data[client_name] = {}
-                data[client_name]['total'] = plant_price
-            else:
-                data[client_name]['total'] += plant_price
-
-            # Update existing plant
-            if plant_name in data[client_name]:
-                data[client_name][plant_name]['count'] += 1
-                data[client_name][plant_name]['price'] += plant_price
-            else:
-                # Add new plant
-                data_entry = {
-                    'name': plant_name,
-                    'count': 1,
-                    'price': plant_price
-                }
-                data[client_name][plant_name] = data_entry
-
         return jsonify({
             'success': True,
             'message': 'Follow up & keep the plants alive',
-            'data': data
+            'data': report['data']
         })
     except Exception as e:
+        log_exception(e)
         abort(404)
 
 
 @app.route('/renters')
-@requires_auth('get:renters')
+@requires_auth('get:renters',
+               limit=RateLimit(rate=1, burst=5, concurrency=4))
+@single_flight.coalesce
 def get_renters(jwt):
-    """View a list of all plant renters
-    :return: JSON with keys 'success' & 'data' (id, name, address, city, state)
+    """View the plant renters a page at a time, limited to the columns named
+    by the optional 'fields' query parameter. The optional 'name' & 'state'
+    query parameters look renters up, 'limit' (default MAX_PAGE_SIZE) &
+    'after' (an id) page them
+    :return: JSON with keys 'success', 'data' (id, name, address, city,
+    state) & 'next' (the 'after' of the next page, None on the last one)
     """
+    fields = get_fields(Renter.LONG_FIELDS, Renter.LONG_FIELDS)
+
+    limit = request.args.get('limit', MAX_PAGE_SIZE, type=int)
+    after = request.args.get('after', type=int)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(422)
+
     try:
-        results = Renter.query.all()
+        query = select_fields(Renter, fields)
+        if request.args.get('name'):
+            query = query.filter(Renter.name == request.args['name'])
+        if request.args.get('state'):
+            query = query.filter(Renter.state == request.args['state'])
+        if after is not None:
+            query = query.filter(Renter.id > after)
+
+        results = query.order_by(Renter.id).limit(limit).all()
         data = []
         if not results:
             return jsonify({
                 'success': True,
-                'data': None
+                'data': None,
+                'next': None
             })
 
-        data = [renter.long() for renter in results]
+        data = [renter._asdict() for renter in results]
+
+        return jsonify({
+            'success': True,
+            'data': data,
+            'next': data[-1]['id'] if len(data) == limit else None
+        })
+    except Exception as e:
+        log_exception(e)
+        abort(404)
+
+
+@app.route('/renters/<int:renter_id>')
+@requires_auth('get:renters', limit=RateLimit())
+def get_renter_by_id(jwt, renter_id):
+    """View the renter with the given id
+    :param renter_id: integer id of the renter
+    :return: JSON with keys 'success' & 'renter' (id, name, address, city,
+    state)
+    """
+    try:
+        renter = Renter.query.get_or_404(renter_id)
+
+        return jsonify({
+            'success': True,
+            'renter': renter.long()
+        })
+    except Exception as e:
+        log_exception(e)
+        abort(404)
+
+
+@app.route('/renters/bulk', methods=['POST'])
+@requires_auth('post:renters', limit=RateLimit(rate=1, burst=5))
+@idempotent
+def add_renters(jwt):
+    """Adds many renters at once, in chunked transactions. Renters whose
+    name is already taken are skipped and listed in 'conflicts'
+    :return: JSON with keys 'success', 'created' & 'conflicts'
+    """
+    renters = (request.get_json(silent=True) or {}).get('renters')
+    fields = [field for field in Renter.LONG_FIELDS if field != 'id']
+
+    if not isinstance(renters, list) or not renters or \
+            len(renters) > MAX_BULK_SIZE or \
+            not all(isinstance(renter, dict) and
+                    all(isinstance(renter.get(field), str) and
+                        renter.get(field) for field in fields)
+                    for renter in renters):
+        abort(422)
+
+    try:
+        created, conflicts = Renter.bulk_insert(
+            [{field: renter[field] for field in fields}
+             for renter in renters])
 
         return jsonify({
             'success': True,
-            'data': data
+            'created': created,
+            'conflicts': conflicts
         })
     except Exception as e:
+        log_exception(e)
+        abort(422)
+
+
+@app.route('/reports/rented', methods=['POST'])
+@requires_auth('get:rented', limit=RateLimit())
+@idempotent
+def queue_rented_report(jwt):
+    """Queues the report of all rented plants and who rented them
+    :return: Status code 202 and JSON with keys 'success' & 'report'
+    """
+    try:
+        report = jobs.enqueue('rented', 'get:rented', jwt.get('sub'))
+
+        return jsonify({
+            'success': True,
+            'report': report.short()
+        }), 202, {'Location': f'/reports/{report.id}'}
+    except Exception as e:
+        log_exception(e)
+        abort(422)
+
+
+@app.route('/reports/invoice/<int:renter_id>', methods=['POST'])
+@requires_auth('get:invoice', limit=RateLimit())
+@idempotent
+def queue_invoice_report(jwt, renter_id):
+    """Queues the invoice of the specified renter
+    :param renter_id: integer id of the renter
+    :return: Status code 202 and JSON with keys 'success' & 'report'
+    """
+    get_period()
+
+    try:
+        report = jobs.enqueue('invoice', 'get:invoice', jwt.get('sub'),
+                              renter_id=renter_id,
+                              start=request.args.get('from') or None,
+                              end=request.args.get('to') or None)
+
+        return jsonify({
+            'success': True,
+            'report': report.short()
+        }), 202, {'Location': f'/reports/{report.id}'}
+    except Exception as e:
+        log_exception(e)
+        abort(422)
+
+
+@app.route('/reports/<report_id>')
+@requires_auth(None)
+def get_report(jwt, report_id):
+    """View the status of a queued report and its result once done.
+    Requires the same permission as the report's synchronous route
+    :param report_id: id returned when the report was queued
+    :return: JSON with keys 'success' & 'report'
+    """
+    report = Report.query.get_or_404(report_id)
+    check_permissions(report.permission, jwt)
+    jobs.expire(report)
+
+    return jsonify({
+        'success': True,
+        'report': report.long()
+    })
+
+
+@app.route('/events')
+@requires_auth('get:events', limit=RateLimit())
+def get_events(jwt):
+    """Catalog and rental changes with a seq greater than the 'after' query
+    parameter (or the Last-Event-ID header), oldest first. 'wait' long-polls
+    up to that many seconds when there are none yet. Clients accepting
+    text/event-stream get a Server-Sent Events stream instead
+    :return: JSON with keys 'success', 'events' & 'last' (seq to pass as
+    'after' next time)
+    """
+    after = request.args.get('after', type=int)
+    if after is None:
+        after = request.headers.get('Last-Event-ID', 0, type=int)
+    limit = request.args.get('limit', 100, type=int)
+    wait = request.args.get('wait', 0, type=float)
+    if after < 0 or not 0 < limit <= MAX_PAGE_SIZE or \
+            not 0 <= wait <= EVENTS_MAX_WAIT:
+        abort(422)
+
+    if request.accept_mimetypes.best_match(
+            ['application/json', 'text/event-stream']) == 'text/event-stream':
+        return Response(stream_with_context(stream_events(after, limit)),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache',
+                                 'X-Accel-Buffering': 'no'})
+
+    try:
+        events = wait_for_events(after, limit, wait)
+
+        return jsonify({
+            'success': True,
+            'events': [change.values() for change in events],
+            'last': events[-1].seq if events else after
+        })
+    except Exception as e:
+        log_exception(e)
         abort(404)
 
 
 @app.route('/add', methods=['POST'])
 @requires_auth('post:plants')
+@idempotent
 def add_plant(jwt):
     """Adds a new plant entry to the catalog
     :return: JSON of plant added to DB
@@ -194,41 +452,60 @@ def add_plant(jwt):
                         price=request.json.get('price'))
 
         plant.insert()
+        catalog_cache.clear()
 
         return jsonify({
             'success': True,
             'plant': plant.long()
         })
     except Exception as e:
+        log_exception(e)
         abort(422)
 
 
 @app.route('/plants/<int:plant_id>', methods=['PATCH'])
 @requires_auth('patch:plants')
+@idempotent
 def update_plant_entry(jwt, plant_id):
-    """Update the plant entry by a given ID value
+    """Update the plant entry by a given ID value. Only the fields present
+    in the request body are changed. With an If-Match header the update only
+    applies if the plant is still at one of its versions (ETags)
     :param plant_id: integer id of the plant to update
     :return: JSON of updated plant
     """
-    try:
-        plant = Catalog.query.get_or_404(plant_id)
-        plant.name = request.json.get('name')
-        plant.description = request.json.get('description')
-        plant.quantity = request.json.get('quantity')
-        plant.price = request.json.get('price')
+    versions = get_if_match()
+    if not isinstance(request.json, dict):
+        abort(422)
 
-        plant.update()
+    values = {field: value for field, value in request.json.items()
+              if field in Catalog.LONG_FIELDS and field != 'id'}
+    if not values:
+        abort(422)
 
-        return jsonify({
-            'success': True,
-            'plant': plant.long()
-        })
+    try:
+        plant = Catalog.update_fields(plant_id, values, versions)
     except Exception as e:
+        log_exception(e)
         abort(422)
 
+    if plant is None:
+        # Tell a missing plant apart from a lost update, only on failure
+        if versions is not None and Catalog.query.get(plant_id) is not None:
+            abort(409)
+        abort(404)
+
+    catalog_cache.clear()
+    version = plant.pop('version_id')
+
+    return jsonify({
+        'success': True,
+        'plant': plant
+    }), 200, {'ETag': f'"{version}"'}
+
 
 @app.route('/plants/<int:plant_id>', methods=['DELETE'])
 @requires_auth('delete:plants')
+@idempotent
 def delete_plant(jwt, plant_id):
     """Deletes the plant with the give ID value
     :param plant_id: integer id for a given plant to be deleted
@@ -238,12 +515,14 @@ def delete_plant(jwt, plant_id):
         plant = Catalog.query.get_or_404(plant_id)
 
         plant.delete()
+        catalog_cache.clear()
 
         return jsonify({
             'success': True,
             'id': plant_id
         })
     except Exception as e:
+        log_exception(e)
         abort(422)
 
 
@@ -263,6 +542,19 @@ def unprocessable(error):
     }), 422
 
 
+@app.errorhandler(409)
+def conflict(error):
+    """Error handler for 409 HTTP status code
+    :param error: The error object
+    :return: JSON indicating failure 'success' bool, 'error' code & 'message'
+    """
+    return jsonify({
+        "success": False,
+        "error": 409,
+        "message": "conflict"
+    }), 409
+
+
 @app.errorhandler(404)
 def not_found(error):
     """
@@ -284,9 +576,23 @@ def auth_error(error):
     :param error: The error object
     :return JSON with 'code' and 'description' of the authorization error
     """
+    g.auth = error.error['code']
 
     return jsonify(error.error), error.status_code
 
 
+@app.errorhandler(RateLimitError)
+def rate_limited(error):
+    """Rate limit error handler. Takes RateLimitErrors and puts them in JSON
+    format with a Retry-After header
+    :param error: The error object
+    :return JSON with 'code' and 'description' of the rate limit error
+    """
+    response = jsonify(error.error)
+    response.headers['Retry-After'] = str(error.retry_after)
+
+    return response, error.status_code
+
+
 if __name__ == '__main__':
     app.run()
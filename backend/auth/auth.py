@@ -1,13 +1,9 @@
-import json
-import os
-from flask import request
+from flask import current_app, g, request
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 
-AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
-ALGORITHMS = [os.environ.get('ALGORITHMS')]
-API_AUDIENCE = os.environ.get('API_AUDIENCE')
+from backend.auth.keys import get_key_provider
+from backend.database.shards import TENANT_CLAIM, shard_for, use_shard
 
 # ---------------------------------------------------------------------------
 # Source: https://github.com/udacity/FSND/blob/master/BasicFlaskAuth/app.py
@@ -101,7 +97,8 @@ def verify_decode_jwt(token):
     :param token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
-    it should verify the token using Auth0 /.well-known/jwks.json
+    it should verify the token using the configured key provider, by default
+    Auth0 /.well-known/jwks.json (see backend/auth/keys.py)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
@@ -112,33 +109,23 @@ def verify_decode_jwt(token):
 
     :return: Decoded payload
     """
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    provider = get_key_provider()
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = provider.get_key(unverified_header['kid'])
     if rsa_key:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=provider.algorithms,
+                audience=provider.audience,
+                issuer=provider.issuer
             )
 
             return payload
@@ -166,16 +153,19 @@ def verify_decode_jwt(token):
     }, 400)
 
 
-def requires_auth(permission=''):
+def requires_auth(permission='', limit=None):
     """
     Enforces required permission
-    :param permission: string permission (i.e. 'post:drink')
+    :param permission: string permission (i.e. 'post:drink') or None when the
+    decorated method checks the permission itself
+    :param limit: optional RateLimit applied per JWT subject and permission
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
     it should use the check_permissions method validate claims and check the
     requested permission return the decorator which passes the decoded
     payload to the decorated method
+    it should route the request to the shard of the tenant claim
 
     :return: the decorator which passes the decoded payload to the decorated
     method
@@ -188,14 +178,30 @@ def requires_auth(permission=''):
 
             try:
                 payload = verify_decode_jwt(token)
-                check_permissions(permission, payload)
+                if permission is not None:
+                    check_permissions(permission, payload)
             except Exception as e:
                 raise AuthError({
                     'code': 'invalid_token',
                     'description': 'Access denied due to invalid token'
                 }, 401)
 
-            return f(payload, *args, **kwargs)
+            g.sub = payload.get('sub')
+            try:
+                use_shard(shard_for(current_app, payload.get(TENANT_CLAIM),
+                                    required=True))
+            except KeyError:
+                raise AuthError({
+                    'code': 'unknown_tenant',
+                    'description': 'Tenant not found.'
+                }, 403)
+
+            g.auth = 'ok'
+            if limit is None:
+                return f(payload, *args, **kwargs)
+
+            with limit.admit(payload.get('sub'), permission):
+                return f(payload, *args, **kwargs)
 
         return wrapper
 
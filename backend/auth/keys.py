@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk, jwt
+
+from backend.cache.shared import shared_cache
+
+AUTH_KEY_PROVIDER = os.environ.get('AUTH_KEY_PROVIDER', 'remote')
+AUTH0_DOMAIN = os.environ.get('AUTH0_DOMAIN')
+ALGORITHMS = [os.environ.get('ALGORITHMS')]
+API_AUDIENCE = os.environ.get('API_AUDIENCE')
+JWKS_FILE = os.environ.get('JWKS_FILE')
+JWKS_CACHE_TTL = int(os.environ.get('JWKS_CACHE_TTL', 600))
+AUTH_ISSUER = os.environ.get('AUTH_ISSUER', 'https://plants4rent.local/')
+AUTH_SECRET = os.environ.get('AUTH_SECRET')
+AUTH_PRIVATE_KEY_FILE = os.environ.get('AUTH_PRIVATE_KEY_FILE')
+
+
+def find_key(jwks, kid):
+    """Finds the RSA key with the given key id in a JSON Web Key Set
+    :param jwks: dict with a 'keys' list
+    :param kid: key id from the token header
+    :return: the key or an empty dict
+    """
+    for key in jwks['keys']:
+        if key['kid'] == kid:
+            return {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return {}
+
+
+# ---------------------------------------------------------------------------
+# Key Providers
+# ---------------------------------------------------------------------------
+
+class RemoteJWKS:
+    """Keys from the Auth0 /.well-known/jwks.json endpoint.
+    The key set is cached for JWKS_CACHE_TTL seconds and refetched early,
+    at most every 30 seconds, when a token names an unknown key id. With a
+    SharedCache the key set is fetched once per host, not once per worker
+    """
+
+    def __init__(self, domain=AUTH0_DOMAIN, algorithms=ALGORITHMS,
+                 ttl=JWKS_CACHE_TTL, shared=None, audience=API_AUDIENCE):
+        self.url = f'https://{domain}/.well-known/jwks.json'
+        self.issuer = 'https://' + str(domain) + '/'
+        self.audience = audience
+        self.algorithms = algorithms
+        self.ttl = ttl
+        self.shared = shared
+        self.jwks = None
+        self.fetched_at = 0.0
+        self.lock = threading.Lock()
+
+    def _load_shared(self):
+        """Uses the key set another worker fetched, unless it expired
+        :return: True when a fresh shared key set was found
+        """
+        found = self.shared.read(self.url, self.shared.generation())
+        if found is None:
+            return False
+
+        meta, sections = found
+        age = time.time() - meta['fetched_at']
+        if age > self.ttl:
+            return False
+
+        self.jwks = json.loads(bytes(sections['jwks']))
+        self.fetched_at = time.monotonic() - age
+        return True
+
+    def _fetch(self, shared=True):
+        if shared and self.shared is not None and self._load_shared():
+            return
+
+        jsonurl = urlopen(self.url)
+        body = jsonurl.read()
+        self.jwks = json.loads(body)
+        self.fetched_at = time.monotonic()
+
+        if self.shared is not None:
+            self.shared.write(self.url, {'fetched_at': time.time()},
+                              {'jwks': body}, self.shared.generation())
+
+    def get_key(self, kid):
+        with self.lock:
+            age = time.monotonic() - self.fetched_at
+            if self.jwks is None or age > self.ttl:
+                self._fetch()
+                age = time.monotonic() - self.fetched_at
+
+            key = find_key(self.jwks, kid)
+            if not key and age > 30:
+                # The signing keys may have been rotated
+                self._fetch(shared=False)
+                key = find_key(self.jwks, kid)
+
+        return key
+
+
+class LocalJWKS:
+    """Keys from a JSON Web Key Set file, i.e. a saved copy of the Auth0
+    jwks.json, so tokens can be verified without network access
+    """
+
+    def __init__(self, path=JWKS_FILE, issuer=None, algorithms=ALGORITHMS,
+                 audience=API_AUDIENCE):
+        with open(path) as jwks_file:
+            self.jwks = json.load(jwks_file)
+        self.issuer = issuer or 'https://' + str(AUTH0_DOMAIN) + '/'
+        self.audience = audience
+        self.algorithms = algorithms
+
+    def get_key(self, kid):
+        return find_key(self.jwks, kid)
+
+
+class LocalIssuer:
+    """Mints and verifies its own tokens, for tests and load tests.
+    Signs with HS256 and a shared secret, or with RS256 and a PEM private key.
+    Without either it makes up a random secret, only this object can verify
+    its tokens then
+    EXAMPLE
+        issuer = LocalIssuer(secret='not-so-secret')
+        token = issuer.mint('auth0|manager', ['get:rented'])
+    """
+
+    kid = 'local'
+
+    def __init__(self, secret=AUTH_SECRET, private_key=None,
+                 issuer=AUTH_ISSUER, audience=API_AUDIENCE):
+        self.issuer = issuer
+        self.audience = audience
+
+        if private_key:
+            self.algorithms = ['RS256']
+            self.signing_key = private_key
+            self.verifying_key = jwk.construct(private_key, 'RS256') \
+                .public_key().to_pem()
+        else:
+            self.algorithms = ['HS256']
+            self.signing_key = self.verifying_key = secret or \
+                os.urandom(32).hex()
+
+    def get_key(self, kid):
+        return self.verifying_key if kid == self.kid else {}
+
+    def mint(self, subject, permissions, expires_in=3600, **claims):
+        """Creates a signed access token
+        :param subject: the 'sub' claim
+        :param permissions: list of permission strings
+        :param expires_in: seconds until the token expires
+        :return: the encoded JWT
+        """
+        now = int(time.time())
+        claims.update({
+            'iss': self.issuer,
+            'sub': subject,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        })
+        if self.audience:
+            claims['aud'] = self.audience
+
+        return jwt.encode(claims, self.signing_key,
+                          algorithm=self.algorithms[0],
+                          headers={'kid': self.kid})
+
+
+_provider = None
+
+
+def get_key_provider():
+    """The key provider selected by AUTH_KEY_PROVIDER: 'remote' (Auth0,
+    the default), 'file' (JWKS_FILE) or 'local' (AUTH_SECRET or
+    AUTH_PRIVATE_KEY_FILE). Raises a ValueError when 'local' has neither,
+    each worker would otherwise verify with a random secret of its own
+    """
+    global _provider
+    if _provider is None:
+        if AUTH_KEY_PROVIDER == 'file':
+            _provider = LocalJWKS()
+        elif AUTH_KEY_PROVIDER == 'local':
+            if not AUTH_SECRET and not AUTH_PRIVATE_KEY_FILE:
+                raise ValueError('AUTH_KEY_PROVIDER=local needs AUTH_SECRET '
+                                 'or AUTH_PRIVATE_KEY_FILE')
+            private_key = None
+            if AUTH_PRIVATE_KEY_FILE:
+                with open(AUTH_PRIVATE_KEY_FILE) as key_file:
+                    private_key = key_file.read()
+            _provider = LocalIssuer(private_key=private_key)
+        else:
+            _provider = RemoteJWKS(shared=shared_cache('jwks'))
+    return _provider
+
+
+def set_key_provider(provider):
+    """Replaces the key provider, i.e. with a LocalIssuer in tests"""
+    global _provider
+    _provider = provider
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Mint a token with the local issuer (AUTH_KEY_PROVIDER='
+                    'local and the same AUTH_SECRET or AUTH_PRIVATE_KEY_FILE '
+                    'as the server)')
+    parser.add_argument('subject')
+    parser.add_argument('permissions', nargs='*')
+    parser.add_argument('--expires-in', type=int, default=3600)
+    args = parser.parse_args()
+
+    if AUTH_KEY_PROVIDER != 'local':
+        parser.error('AUTH_KEY_PROVIDER must be "local"')
+    if not AUTH_SECRET and not AUTH_PRIVATE_KEY_FILE:
+        parser.error('AUTH_SECRET or AUTH_PRIVATE_KEY_FILE must be set')
+    print(get_key_provider().mint(args.subject, args.permissions,
+                                  args.expires_in))
@@ -0,0 +1,194 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', 5))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 20))
+RATE_LIMIT_CONCURRENCY = int(os.environ.get('RATE_LIMIT_CONCURRENCY', 8))
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE')
+
+
+# ---------------------------------------------------------------------------
+# RateLimitError Exception
+# ---------------------------------------------------------------------------
+
+class RateLimitError(Exception):
+    """A standardized way to communicate that a caller has to back off.
+    Carries the number of seconds the caller should wait (Retry-After)
+    """
+
+    def __init__(self, error, status_code, retry_after):
+        self.error = error
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+# ---------------------------------------------------------------------------
+# Bucket Stores
+# ---------------------------------------------------------------------------
+
+class MemoryBucketStore:
+    """Token buckets kept in the memory of the current process.
+    Fast, but every gunicorn worker keeps its own buckets. At most max_keys
+    buckets are kept, the least recently used one is dropped for a new key
+    (a dropped bucket starts full again)
+    """
+
+    def __init__(self, max_keys=10000, clock=time.monotonic):
+        self.buckets = OrderedDict()
+        self.clock = clock
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Takes a single token from the bucket identified by key
+        :param key: bucket identifier (i.e. 'auth0|123:get:rented')
+        :param rate: tokens added to the bucket per second
+        :param burst: maximum number of tokens the bucket can hold
+        :return: 0 if a token was taken, otherwise seconds until one is free
+        """
+        with self.lock:
+            now = self.clock()
+            tokens, last = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+
+            retry_after = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not retry_after:
+                tokens -= 1
+
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+            return retry_after
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class SQLiteBucketStore:
+    """Token buckets kept in a local SQLite file so all gunicorn workers on
+    the host share the same limits. Each take() is a single IMMEDIATE
+    transaction, which serializes the read-modify-write across processes
+    """
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.local = threading.local()
+
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'key TEXT PRIMARY KEY, tokens REAL, last REAL)')
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst):
+        """Takes a single token from the bucket identified by key
+        :return: 0 if a token was taken, otherwise seconds until one is free
+        """
+        now = self.clock()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, last FROM buckets '
+                               'WHERE key = ?', (key,)).fetchone()
+            tokens, last = row if row else (burst, now)
+            tokens = min(burst, tokens + (now - last) * rate)
+
+            retry_after = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not retry_after:
+                tokens -= 1
+
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, last) '
+                         'VALUES (?, ?, ?)', (key, tokens, now))
+            conn.execute('COMMIT')
+            return retry_after
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def clear(self):
+        self._connection().execute('DELETE FROM buckets')
+
+
+_store = None
+
+
+def get_store():
+    """The shared bucket store. Uses the SQLite file at RATE_LIMIT_STORE
+    when set, otherwise keeps the buckets in process memory
+    """
+    global _store
+    if _store is None:
+        if RATE_LIMIT_STORE:
+            _store = SQLiteBucketStore(RATE_LIMIT_STORE)
+        else:
+            _store = MemoryBucketStore()
+    return _store
+
+
+# ---------------------------------------------------------------------------
+# Rate Limit
+# ---------------------------------------------------------------------------
+
+class RateLimit:
+    """Admission control for a single route.
+    A token bucket per (JWT sub, permission, route) limits how often a
+    caller may use the route and a semaphore (bulkhead) caps how many
+    requests the route runs at once in this process
+    EXAMPLE
+        @requires_auth('get:rented', limit=RateLimit(rate=1, burst=5))
+    """
+
+    def __init__(self, rate=None, burst=None, concurrency=None, store=None):
+        self.rate = rate or RATE_LIMIT_RATE
+        self.burst = burst or RATE_LIMIT_BURST
+        self.concurrency = concurrency or RATE_LIMIT_CONCURRENCY
+        self.store = store
+        self.bulkhead = threading.BoundedSemaphore(self.concurrency)
+
+    @contextmanager
+    def admit(self, subject, permission):
+        """Admits the caller or raises a RateLimitError. The bulkhead is
+        checked first so a request it turns away costs no token
+        :param subject: the 'sub' claim of the decoded JWT
+        :param permission: the permission the route requires
+        """
+        if not self.bulkhead.acquire(blocking=False):
+            raise RateLimitError({
+                'code': 'too_busy',
+                'description': 'Too many requests in progress. Please, '
+                               'try again shortly.'
+            }, 429, 1)
+
+        try:
+            # Routes sharing a permission have their own limits, and so
+            # their own buckets
+            route = request.endpoint if has_request_context() else None
+            store = self.store or get_store()
+            retry_after = store.take(f'{subject}:{permission}:{route}',
+                                     self.rate, self.burst)
+            if retry_after:
+                raise RateLimitError({
+                    'code': 'rate_limited',
+                    'description': 'Too many requests. Please, slow down.'
+                }, 429, math.ceil(retry_after))
+
+            yield
+        finally:
+            self.bulkhead.release()
@@ -0,0 +1,69 @@
+"""Benchmark of the requires_auth -> route path with locally minted tokens,
+so it runs without network access to Auth0
+EXAMPLE
+    python -m backend.benchmarks.bench_auth --private-key key.pem
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+# A scratch SQLite file overrides DATABASE_PATH, go() drops the tables
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_auth.db')
+os.environ['DATABASE_PATH'] = 'sqlite:///' + DB_FILE
+# Measure authentication, not admission control
+os.environ.setdefault('RATE_LIMIT_RATE', '1e9')
+os.environ.setdefault('RATE_LIMIT_BURST', '1e9')
+
+from backend.app import app  # noqa: E402
+from backend.auth.auth import verify_decode_jwt  # noqa: E402
+from backend.auth.keys import LocalIssuer, set_key_provider  # noqa: E402
+from backend.load_db import go  # noqa: E402
+
+NUMBER = 2000
+
+
+def report(name, seconds, number=NUMBER):
+    print(f'{name:<28}{seconds / number * 1e6:>10.1f} us'
+          f'{number / seconds:>10.0f} req/s')
+
+
+def bench(issuer, label):
+    set_key_provider(issuer)
+    token = issuer.mint('auth0|benchmark', ['get:invoice'])
+    headers = {'Authorization': 'Bearer ' + token}
+    client = app.test_client()
+
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        verify_decode_jwt(token)
+    report(f'{label} verify_decode_jwt', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        client.get('/invoice/1', headers=headers)
+    report(f'{label} GET /invoice/1', time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        client.get('/plants')
+    report('public GET /plants', time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--private-key', help='PEM file to also bench RS256')
+    args = parser.parse_args()
+
+    with app.app_context():
+        go()
+
+    bench(LocalIssuer(secret='benchmark'), 'HS256')
+    if args.private_key:
+        with open(args.private_key) as key_file:
+            bench(LocalIssuer(private_key=key_file.read()), 'RS256')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark of bytes on the wire and CPU per request for /plants.
+Compares identity, compressing on every request, the first request after a
+catalog write (which compresses the cached variant) and serving the
+precompressed variant kept by the response cache
+EXAMPLE
+    python -m backend.benchmarks.bench_compression --plants 5000
+"""
+
+import argparse
+import json
+import timeit
+
+from backend.cache.response import CachedBody
+from backend.middleware.compression import brotli, compress
+
+NUMBER = 200
+PLANTS = 500
+
+
+def catalog_body(count=PLANTS):
+    """A /plants body for a wide catalog with realistic descriptions"""
+    plants = [{
+        'id': i,
+        'name': f'Plant {i}',
+        'description': f'Plant {i} fits in well in just about every style '
+                       'of interior design, particular country and causal '
+                       'looks. Water weekly and keep out of direct sun.'
+    } for i in range(count)]
+
+    return json.dumps({
+        'success': True,
+        'plants': plants,
+        'message': 'Enjoy our wonderful selection'
+    }).encode()
+
+
+def report(name, size, seconds):
+    print(f'{name:<24}{size:>10} bytes{seconds / NUMBER * 1e6:>12.1f} '
+          f'us/request')
+
+
+def first_hit(body, encoding):
+    """Compresses the variant of a new cache entry, as the first request
+    after every catalog write does
+    """
+    return CachedBody(body, 'application/json').encoded(encoding)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--plants', type=int, default=PLANTS)
+    args = parser.parse_args()
+
+    body = catalog_body(args.plants)
+    encodings = ['gzip'] + (['br'] if brotli else [])
+
+    report('identity', len(body), 0.0)
+    for encoding in encodings:
+        report(f'{encoding} per request', len(compress(body, encoding)),
+               timeit.timeit(lambda: compress(body, encoding),
+                             number=NUMBER))
+
+        report(f'{encoding} first hit', len(first_hit(body, encoding)),
+               timeit.timeit(lambda: first_hit(body, encoding),
+                             number=NUMBER))
+
+        cached = CachedBody(body, 'application/json')
+        report(f'{encoding} cached', len(cached.encoded(encoding)),
+               timeit.timeit(lambda: cached.encoded(encoding),
+                             number=NUMBER))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Benchmark of payload size and latency of sparse fieldsets on a wide
+catalog, with the response cache cleared so every request hits the database
+EXAMPLE
+    python -m backend.benchmarks.bench_fields --plants 5000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+# A scratch SQLite file overrides DATABASE_PATH, the tables are dropped
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_fields.db')
+os.environ['DATABASE_PATH'] = 'sqlite:///' + DB_FILE
+
+from backend.app import app, catalog_cache  # noqa: E402
+from backend.database.models import Catalog, db, \
+    db_drop_and_create_all  # noqa: E402
+
+NUMBER = 50
+DESCRIPTION = 'Peace lily fits in well in just about every style of ' \
+              'interior design, particular country and causal looks. '
+
+
+def bench(client, url):
+    start = time.perf_counter()
+    for _ in range(NUMBER):
+        catalog_cache.clear()
+        response = client.get(url)
+    elapsed = (time.perf_counter() - start) / NUMBER
+
+    print(f'{url:<36}{len(response.data):>12} bytes'
+          f'{elapsed * 1e3:>10.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--plants', type=int, default=5000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db_drop_and_create_all()
+        db.session.execute(Catalog.__table__.insert(), [{
+            'name': f'Plant {i}', 'description': DESCRIPTION * 20,
+            'quantity': 10, 'price': 9.97} for i in range(args.plants)])
+        db.session.commit()
+
+    client = app.test_client()
+    for url in ('/plants', '/plants?fields=name',
+                '/plants?fields=name,price'):
+        bench(client, url)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Micro-benchmark for the admission control added by RateLimit.
+Compares the cost of admitting a request against calling the route bare
+EXAMPLE
+    python -m backend.benchmarks.bench_ratelimit
+"""
+
+import os
+import tempfile
+import timeit
+
+from backend.auth.ratelimit import MemoryBucketStore, RateLimit, \
+    SQLiteBucketStore
+
+NUMBER = 100000
+
+
+def route():
+    return None
+
+
+def admitted(limit):
+    """Runs the route through the rate limiter"""
+    with limit.admit('auth0|benchmark', 'get:rented'):
+        return route()
+
+
+def report(name, seconds, number):
+    print(f'{name:<24}{seconds / number * 1e6:>10.2f} us/request')
+
+
+def main():
+    # A bucket that never runs dry so every call takes the admit path
+    memory = RateLimit(rate=1e9, burst=1e9, store=MemoryBucketStore())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shared = RateLimit(rate=1e9, burst=1e9, store=SQLiteBucketStore(
+            os.path.join(tmp, 'buckets.db')))
+
+        report('bare route', timeit.timeit(route, number=NUMBER), NUMBER)
+        report('memory store', timeit.timeit(lambda: admitted(memory),
+                                             number=NUMBER), NUMBER)
+        report('sqlite store', timeit.timeit(lambda: admitted(shared),
+                                             number=NUMBER // 10),
+               NUMBER // 10)
+
+
+if __name__ == '__main__':
+    main()
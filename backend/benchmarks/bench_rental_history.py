@@ -0,0 +1,101 @@
+"""Benchmark of invoice and /rented queries over a large rental history,
+before and after closed rentals are moved to 'RentedArchive'
+EXAMPLE
+    python -m backend.benchmarks.bench_rental_history --rows 2000000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# A scratch SQLite file overrides DATABASE_PATH, the tables are dropped
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_rental_history.db')
+os.environ['DATABASE_PATH'] = 'sqlite:///' + DB_FILE
+
+from backend.app import app  # noqa: E402
+from backend.database.archive import archive_closed_rentals  # noqa: E402
+from backend.database.models import Catalog, Rented, Renter, db, \
+    db_drop_and_create_all  # noqa: E402
+from backend.jobs.reports import build_invoice, build_rented  # noqa: E402
+
+PLANTS = 100
+RENTERS = 1000
+ACTIVE = 0.05
+CHUNK = 50000
+
+
+def populate(rows, now):
+    """Loads the catalog, the renters and rows rentals spread over 3 years"""
+    db.session.execute(Catalog.__table__.insert(), [{
+        'name': f'Plant {i}', 'description': 'A plant', 'quantity': 10,
+        'price': 1.0 + i % 20} for i in range(PLANTS)])
+    db.session.execute(Renter.__table__.insert(), [{
+        'name': f'Renter {i}', 'address': f'{i} Main St',
+        'city': 'Springfield', 'state': 'VA'} for i in range(RENTERS)])
+
+    for offset in range(0, rows, CHUNK):
+        chunk = []
+        for _ in range(min(CHUNK, rows - offset)):
+            started_at = now - timedelta(minutes=random.randint(0, 1576800))
+            ended_at = None
+            if random.random() > ACTIVE:
+                ended_at = min(now, started_at + timedelta(
+                    days=random.randint(1, 60)))
+            plant = random.randrange(PLANTS)
+            chunk.append({'plant_id': plant + 1,
+                          'renter_id': random.randint(1, RENTERS),
+                          'plant_name': f'Plant {plant}',
+                          'price': 1.0 + plant % 20,
+                          'started_at': started_at,
+                          'ended_at': ended_at})
+        db.session.execute(Rented.__table__.insert(), chunk)
+        db.session.commit()
+
+
+def timed(name, func, repeat=5):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    print(f'{name:<36}{(time.perf_counter() - start) / repeat * 1e3:>10.1f}'
+          ' ms')
+
+
+def run_queries(now, label):
+    print(f'-- {label}: {Rented.query.count()} hot rows')
+    month_ago = now - timedelta(days=30)
+    timed('invoice (current)', lambda: build_invoice(42))
+    timed('invoice (last 30 days)', lambda: build_invoice(42, month_ago))
+    timed('invoice (first year)', lambda: build_invoice(
+        42, now - timedelta(days=1095), now - timedelta(days=730)))
+    timed('rented', build_rented, repeat=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000000)
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    with app.app_context():
+        db_drop_and_create_all()
+
+        start = time.perf_counter()
+        populate(args.rows, now)
+        print(f'Loaded {args.rows} rentals in '
+              f'{time.perf_counter() - start:.1f} s')
+
+        run_queries(now, 'single table')
+
+        start = time.perf_counter()
+        moved = archive_closed_rentals(now - timedelta(days=30))
+        print(f'Archived {moved} rentals in '
+              f'{time.perf_counter() - start:.1f} s')
+
+        run_queries(now, 'archived')
+
+
+if __name__ == '__main__':
+    main()
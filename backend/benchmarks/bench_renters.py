@@ -0,0 +1,79 @@
+"""Benchmark of bulk renter onboarding and renter lookups at 1M renters
+EXAMPLE
+    python -m backend.benchmarks.bench_renters --renters 1000000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# A scratch SQLite file overrides DATABASE_PATH, the tables are dropped
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'bench_renters.db')
+os.environ['DATABASE_PATH'] = 'sqlite:///' + DB_FILE
+
+from backend.app import app  # noqa: E402
+from backend.database.models import Renter, db, \
+    db_drop_and_create_all, select_fields  # noqa: E402
+
+STATES = ['CA', 'VA', 'NY', 'HI', 'TX', 'WA', 'OR', 'NV', 'FL', 'GA']
+REQUEST_SIZE = 10000
+NUMBER = 200
+
+
+def timed(name, func, number=NUMBER):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    print(f'{name:<36}{(time.perf_counter() - start) / number * 1e3:>10.2f}'
+          ' ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--renters', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db_drop_and_create_all()
+
+        # Onboard in requests of REQUEST_SIZE, like POST /renters/bulk
+        start = time.perf_counter()
+        for offset in range(0, args.renters, REQUEST_SIZE):
+            Renter.bulk_insert([{
+                'name': f'Renter {i}', 'address': f'{i} Main St',
+                'city': 'Springfield', 'state': STATES[i % len(STATES)]}
+                for i in range(offset, min(offset + REQUEST_SIZE,
+                                           args.renters))])
+        elapsed = time.perf_counter() - start
+        print(f'Onboarded {args.renters} renters in {elapsed:.1f} s '
+              f'({args.renters / elapsed:.0f} renters/s)')
+
+        start = time.perf_counter()
+        created, conflicts = Renter.bulk_insert([{
+            'name': f'Renter {i}', 'address': f'{i} Main St',
+            'city': 'Springfield', 'state': 'CA'}
+            for i in range(REQUEST_SIZE)])
+        print(f'Re-sent {REQUEST_SIZE} existing renters, {len(conflicts)} '
+              f'conflicts in {time.perf_counter() - start:.2f} s')
+
+        def by_id():
+            Renter.query.get(random.randint(1, args.renters))
+            db.session.expunge_all()
+
+        timed('lookup by id', by_id)
+        timed('lookup by name', lambda: select_fields(
+            Renter, Renter.LONG_FIELDS).filter(
+            Renter.name == f'Renter {random.randrange(args.renters)}').all())
+        timed('lookup by state, page of 100', lambda: select_fields(
+            Renter, Renter.LONG_FIELDS).filter(
+            Renter.state == random.choice(STATES)).filter(
+            Renter.id > random.randrange(args.renters // 2))
+            .order_by(Renter.id).limit(100).all())
+        timed('full listing', lambda: select_fields(
+            Renter, Renter.LONG_FIELDS).all(), number=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Benchmark of the memory each gunicorn worker spends on the cached catalog,
+with per-worker caches and with the shared memory tier (SHARED_CACHE_DIR)
+EXAMPLE
+    python -m backend.benchmarks.bench_shared_cache --workers 8
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# A scratch SQLite file overrides DATABASE_PATH, the tables are dropped
+DB_DIR = tempfile.mkdtemp()
+os.environ['DATABASE_PATH'] = 'sqlite:///' + os.path.join(
+    DB_DIR, 'bench_shared_cache.db')
+# Keep the report readable
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from backend.app import app, catalog_cache  # noqa: E402
+from backend.cache.shared import SharedCache  # noqa: E402
+from backend.database.models import Catalog, db, \
+    db_drop_and_create_all  # noqa: E402
+
+URLS = ('/plants', '/plants?fields=name,description,quantity,price')
+ENCODINGS = ('gzip', 'br', None)
+DESCRIPTION = 'Peace lily fits in well in just about every style of ' \
+              'interior design, particular country and causal looks. '
+
+
+def memory():
+    """Unique (private) and proportional set size of this process in KiB"""
+    sizes = {}
+    with open('/proc/self/smaps_rollup') as rollup:
+        for line in rollup:
+            name, _, value = line.partition(':')
+            if name in ('Pss', 'Private_Clean', 'Private_Dirty'):
+                sizes[name] = int(value.split()[0])
+    return sizes['Private_Clean'] + sizes['Private_Dirty'], sizes['Pss']
+
+
+def fill(client):
+    for url in URLS:
+        for encoding in ENCODINGS:
+            headers = {'Accept-Encoding': encoding} if encoding else {}
+            client.get(url, headers=headers)
+
+
+def worker(index, barrier, results):
+    """Fills the cache like a worker serving the catalog, the first worker
+    before the others, then measures it while every worker holds its copy
+    """
+    client = app.test_client()
+    client.get('/plants/1')
+    uss_before, pss_before = memory()
+
+    if index == 0:
+        fill(client)
+    barrier.wait()
+    if index != 0:
+        fill(client)
+
+    barrier.wait()
+    uss_after, pss_after = memory()
+    results.put((uss_after - uss_before, pss_after - pss_before))
+    barrier.wait()
+
+
+def run(workers, label):
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+
+    # Workers open their own connections after the fork
+    db.engine.dispose()
+    processes = [context.Process(target=worker,
+                                 args=(index, barrier, results))
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+    measured = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    uss = sum(size for size, _ in measured) / workers
+    pss = sum(size for _, size in measured) / workers
+    print(f'{label:<24}{uss:>12.0f} KiB USS{pss:>12.0f} KiB PSS'
+          ' per worker')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--plants', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db_drop_and_create_all()
+        db.session.execute(Catalog.__table__.insert(), [{
+            'name': f'Plant {i}', 'description': DESCRIPTION,
+            'quantity': 10, 'price': 9.97} for i in range(args.plants)])
+        db.session.commit()
+
+    directory = tempfile.mkdtemp(dir='/dev/shm'
+                                 if os.path.isdir('/dev/shm') else None)
+    try:
+        # The same cache object, switched between the two tiers
+        catalog_cache.shared = None
+        catalog_cache.clear()
+        run(args.workers, 'per-worker cache')
+
+        catalog_cache.shared = SharedCache(directory, 'catalog')
+        catalog_cache.seen_generation = catalog_cache.current_generation()
+        catalog_cache.clear()
+        run(args.workers, 'shared memory cache')
+    finally:
+        shutil.rmtree(directory)
+        shutil.rmtree(DB_DIR)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+"""Load test replaying the manager & renter flows of the postman collection
+against a server, checked against saved performance budgets
+EXAMPLE
+    # in-process server on a temporary SQLite database
+    python -m backend.benchmarks.load_test --serve --duration 30
+
+    # a running server started with AUTH_KEY_PROVIDER=local & AUTH_SECRET
+    python -m backend.benchmarks.load_test --host http://localhost:5000 \
+        --mix manager=1,renter=9 --concurrency 32 --duration 60
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__),
+                            'load_test_budgets.json')
+
+MANAGER_PERMISSIONS = ['get:invoice', 'get:rented', 'get:renters',
+                       'post:plants', 'patch:plants', 'delete:plants']
+RENTER_PERMISSIONS = ['get:invoice', 'get:rented', 'get:renters']
+PERMISSIONS = {'manager': MANAGER_PERMISSIONS, 'renter': RENTER_PERMISSIONS}
+
+
+# ---------------------------------------------------------------------------
+# Flows
+# ---------------------------------------------------------------------------
+# Each step is (endpoint, method, path, JSON body, expected statuses). The
+# collection's requests are placeholders, so the flows follow the API docs
+
+def manager_flow(user):
+    plant = {'name': f'Load test plant {user}', 'description': 'A plant',
+             'quantity': 10, 'price': 9.97}
+    yield 'GET /plants', 'GET', '/plants', None, (200,)
+    yield 'GET /plants/<id>', 'GET', f'/plants/{random.randint(1, 4)}', \
+        None, (200,)
+    yield 'GET /rented', 'GET', '/rented', None, (200,)
+    yield 'GET /renters', 'GET', '/renters', None, (200,)
+    yield 'GET /invoice/<id>', 'GET', f'/invoice/{random.randint(1, 4)}', \
+        None, (200,)
+
+    reply = yield 'POST /add', 'POST', '/add', plant, (200,)
+    if reply:
+        plant_id = reply['plant']['id']
+        yield 'PATCH /plants/<id>', 'PATCH', f'/plants/{plant_id}', \
+            {'price': 10.97}, (200,)
+        yield 'DELETE /plants/<id>', 'DELETE', f'/plants/{plant_id}', \
+            None, (200,)
+
+
+def renter_flow(user):
+    yield 'GET /plants', 'GET', '/plants', None, (200,)
+    yield 'GET /plants/<id>', 'GET', f'/plants/{random.randint(1, 4)}', \
+        None, (200,)
+    yield 'GET /invoice/<id>', 'GET', f'/invoice/{random.randint(1, 4)}', \
+        None, (200,)
+    yield 'GET /rented', 'GET', '/rented', None, (200,)
+    yield 'GET /renters', 'GET', '/renters', None, (200,)
+    # Renters may not change the catalog. Refused calls get labels of their
+    # own, so their fast replies do not flatter the real writes
+    yield 'POST /add (refused)', 'POST', '/add', \
+        {'name': f'Not allowed {user}'}, (401, 403)
+    yield 'PATCH /plants/<id> (refused)', 'PATCH', \
+        f'/plants/{random.randint(1, 4)}', {'price': 0.01}, (401, 403)
+    yield 'DELETE /plants/<id> (refused)', 'DELETE', \
+        f'/plants/{random.randint(1, 4)}', None, (401, 403)
+
+
+FLOWS = {'manager': manager_flow, 'renter': renter_flow}
+
+
+def parse_mix(value):
+    """Reads comma separated flow=weight pairs, i.e. 'manager=1,renter=9'"""
+    mix = {}
+    for pair in value.split(','):
+        flow, _, weight = pair.strip().partition('=')
+        if flow not in FLOWS:
+            raise argparse.ArgumentTypeError(f'unknown flow {flow}')
+        mix[flow] = float(weight or 1)
+    return mix
+
+
+# ---------------------------------------------------------------------------
+# Runner
+# ---------------------------------------------------------------------------
+
+class Results:
+    """Latencies & outcomes per endpoint, shared by the virtual users"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.limited = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, latency, error, limited):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.errors[endpoint] += error
+            self.limited[endpoint] += limited
+
+
+def send(host, token, method, path, body):
+    """Sends one request
+    :return: tuple of the status code (0 when unreachable) & the JSON reply
+    """
+    data = json.dumps(body).encode() if body is not None else None
+    request = Request(host + path, data=data, method=method, headers={
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': 'application/json'
+    })
+    try:
+        with urlopen(request, timeout=30) as response:
+            return response.status, response.read()
+    except HTTPError as e:
+        return e.code, e.read()
+    except (URLError, OSError):
+        return 0, b''
+
+
+def virtual_user(number, host, issuer, mix, deadline, results,
+                 allow_limited=False):
+    """Runs flows picked by weight until the deadline. Every iteration acts
+    as a new user with its own token, like many people using the app, so
+    the per user rate limits are not what is measured
+    :param allow_limited: do not count 429 responses as errors
+    """
+    flows = list(mix)
+    weights = [mix[flow] for flow in flows]
+    iteration = 0
+
+    while time.monotonic() < deadline:
+        flow = random.choices(flows, weights)[0]
+        user = f'{flow}-{number}-{iteration}'
+        token = issuer.mint(f'loadtest|{user}', PERMISSIONS[flow])
+        iteration += 1
+
+        steps = FLOWS[flow](user)
+        reply = None
+        while True:
+            try:
+                endpoint, method, path, body, expected = steps.send(reply)
+            except StopIteration:
+                break
+
+            started = time.perf_counter()
+            status, data = send(host, token, method, path, body)
+            latency = time.perf_counter() - started
+
+            limited = status == 429
+            results.add(endpoint, latency, status not in expected and
+                        not (limited and allow_limited), limited)
+            reply = None
+            if status == 200 and method == 'POST':
+                reply = json.loads(data)
+
+
+def percentile(values, share):
+    """Nearest rank percentile of sorted values"""
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def report(results, elapsed):
+    """Prints and returns the statistics per endpoint"""
+    stats = {}
+    print(f'{"endpoint":<32}{"req/s":>9}{"p50 ms":>9}{"p95 ms":>9}'
+          f'{"p99 ms":>9}{"errors":>9}{"429s":>9}')
+
+    for endpoint in sorted(results.latencies):
+        latencies = sorted(results.latencies[endpoint])
+        count = len(latencies)
+        stats[endpoint] = {
+            'throughput': count / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'error_rate': results.errors[endpoint] / count,
+            'limited_rate': results.limited[endpoint] / count
+        }
+        row = stats[endpoint]
+        print(f'{endpoint:<32}{row["throughput"]:>9.1f}{row["p50_ms"]:>9.1f}'
+              f'{row["p95_ms"]:>9.1f}{row["p99_ms"]:>9.1f}'
+              f'{row["error_rate"]:>9.2%}{row["limited_rate"]:>9.2%}')
+
+    return stats
+
+
+def check_budgets(stats, budgets):
+    """Compares the statistics with the budgets of each endpoint
+    :param budgets: dict of endpoint to limits, any of 'max_p95_ms',
+    'max_p99_ms', 'max_error_rate', 'max_limited_rate' & 'min_throughput'
+    :return: list of violation messages
+    """
+    violations = []
+    for endpoint, budget in budgets.items():
+        row = stats.get(endpoint)
+        if row is None:
+            violations.append(f'{endpoint}: no requests')
+            continue
+
+        for name, limit in budget.items():
+            kind, _, metric = name.partition('_')
+            value = row[metric]
+            if kind == 'max' and value > limit or \
+                    kind == 'min' and value < limit:
+                violations.append(f'{endpoint}: {metric} {value:.3f} '
+                                  f'exceeds budget {name} {limit}')
+    return violations
+
+
+def serve():
+    """Starts the app on a temporary SQLite database in this process
+    :return: tuple of the base URL & the token issuer
+    """
+    os.environ['DATABASE_PATH'] = 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(), 'load_test.db')
+    os.environ['AUTH_KEY_PROVIDER'] = 'local'
+    os.environ.setdefault('AUTH_SECRET', os.urandom(32).hex())
+    # The load test measures the app, not the default rate limits
+    os.environ['RATE_LIMIT_RATE'] = '1e9'
+    os.environ['RATE_LIMIT_BURST'] = '1e9'
+    os.environ['RATE_LIMIT_CONCURRENCY'] = '1000'
+    # Keep the report readable, errors are still logged
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    from werkzeug.serving import make_server
+
+    from backend.app import app
+    from backend.auth.keys import get_key_provider
+    from backend.load_db import go
+
+    with app.app_context():
+        go()
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', get_key_provider()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='http://localhost:5000')
+    parser.add_argument('--serve', action='store_true',
+                        help='start the app in-process instead of --host')
+    parser.add_argument('--mix', type=parse_mix,
+                        default=parse_mix('manager=1,renter=9'))
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds')
+    parser.add_argument('--budgets', default=BUDGETS_FILE)
+    parser.add_argument('--save-budgets', action='store_true',
+                        help='write budgets from this run, with headroom')
+    parser.add_argument('--allow-limited', action='store_true',
+                        help='do not count 429 responses as errors')
+    args = parser.parse_args()
+
+    if args.serve:
+        host, issuer = serve()
+    else:
+        from backend.auth.keys import LocalIssuer
+
+        if not os.environ.get('AUTH_SECRET'):
+            parser.error('AUTH_SECRET must be the one of the server')
+        host, issuer = args.host.rstrip('/'), LocalIssuer()
+
+    results = Results()
+    started = time.monotonic()
+    deadline = started + args.duration
+    users = [threading.Thread(target=virtual_user, args=(
+        number, host, issuer, args.mix, deadline, results,
+        args.allow_limited)) for number in range(args.concurrency)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+
+    stats = report(results, time.monotonic() - started)
+
+    if args.save_budgets:
+        budgets = {endpoint: {
+            'max_p95_ms': round(row['p95_ms'] * 2 + 5, 1),
+            # 429s are errors too, /rented & /renters admit 4 at a time
+            'max_error_rate': max(0.01, round(row['error_rate'] * 2, 3)),
+            'max_limited_rate': max(0.01, round(row['limited_rate'] * 2, 3))
+        } for endpoint, row in stats.items()}
+        with open(args.budgets, 'w') as budgets_file:
+            json.dump(budgets, budgets_file, indent=2, sort_keys=True)
+        print(f'Saved budgets to {args.budgets}')
+        return
+
+    with open(args.budgets) as budgets_file:
+        violations = check_budgets(stats, json.load(budgets_file))
+    for violation in violations:
+        print('FAIL', violation)
+    if violations:
+        raise SystemExit(1)
+    print('All budgets met')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, request
+
+from backend.database.shards import current_shard
+from backend.middleware.compression import COMPRESSION_MIN_SIZE, compress, \
+    negotiate_encoding
+
+# Response headers kept with the cached body
+CACHED_HEADERS = ('ETag',)
+# Entries kept per cache, the least recently used ones are dropped
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+# gzip level of the cached variants, brotli uses quality level + 2. Paid on
+# the request thread after every write, so kept moderate: brotli quality 11
+# takes seconds on a 1 MB catalog and compresses no better than 8
+CACHE_COMPRESSION_LEVEL = int(os.environ.get('CACHE_COMPRESSION_LEVEL', 6))
+
+
+class CachedBody:
+    """A cached response body and its compressed variants.
+    Each variant is compressed once, on first request, and reused after.
+    Bodies read from a SharedCache are memoryviews of the shared mapping.
+    An entry of a shared cache takes the variants other workers compressed
+    meanwhile and publishes the ones it compresses
+    """
+
+    def __init__(self, body, mimetype, headers=None, version=None,
+                 shared=None):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers or []
+        self.version = version
+        self.variants = {}
+        # (SharedCache, key, generation) the entry is stored under
+        self.shared = shared
+        self.lock = threading.Lock()
+
+    def encoded(self, encoding):
+        """The body compressed with the given content coding"""
+        variant = self.variants.get(encoding)
+        if variant is None:
+            with self.lock:
+                variant = self.variants.get(encoding)
+                if variant is None:
+                    variant = self._shared_variant(encoding)
+                    compressed = variant is None
+                    if compressed:
+                        variant = compress(self.body, encoding,
+                                           CACHE_COMPRESSION_LEVEL)
+                    self.variants[encoding] = variant
+                    if compressed:
+                        self.publish()
+        return variant
+
+    def _shared_variant(self, encoding):
+        """The variant another worker compressed, None if there is none"""
+        if self.shared is None:
+            return None
+
+        shared, key, generation = self.shared
+        found = shared.read(key, generation)
+        return found[1].get(encoding) if found is not None else None
+
+    def publish(self):
+        """Writes the body and its variants to the shared tier"""
+        if self.shared is None:
+            return
+
+        shared, key, generation = self.shared
+        shared.write(key, {
+            'mimetype': self.mimetype,
+            'headers': self.headers,
+            'version': self.version
+        }, dict(self.variants, identity=self.body), generation)
+
+    def respond(self, accept_encoding):
+        """Builds a response for a client with the given Accept-Encoding"""
+        response = Response(bytes(self.body), mimetype=self.mimetype,
+                            headers=self.headers)
+        encoding = negotiate_encoding(accept_encoding)
+
+        if encoding and len(self.body) >= COMPRESSION_MIN_SIZE:
+            response.set_data(bytes(self.encoded(encoding)))
+            response.headers['Content-Encoding'] = encoding
+
+        return response
+
+
+class ResponseCache:
+    """An in-process cache of response bodies keyed by tenant shard, request
+    path and the query parameters named in params, other parameters are
+    ignored. Holds up to max_entries bodies, least recently used first out.
+    Must be cleared whenever the data behind the cached routes changes, or
+    be given a version function whose result changes with the data, for
+    data written by other processes. With a SharedCache tier the bodies are
+    rendered and compressed once per host and clear() reaches every worker
+    EXAMPLE
+        catalog_cache = ResponseCache()
+
+        @app.route('/plants')
+        @catalog_cache.cached
+        def get_plants():
+            ...
+
+        plant.insert()
+        catalog_cache.clear()
+
+        invoice_cache = ResponseCache(version=rentals_version,
+                                      params=('from', 'to'))
+        catalog_cache = ResponseCache(
+            shared=SharedCache('/dev/shm/plants4rent', 'catalog'))
+    """
+
+    def __init__(self, version=None, shared=None, params=(),
+                 max_entries=CACHE_MAX_ENTRIES):
+        self.entries = OrderedDict()
+        self.params = params
+        self.max_entries = max_entries
+        self.generation = 0
+        self.version = version
+        self.shared = shared
+        self.seen_generation = self.current_generation()
+        self.lock = threading.Lock()
+
+    def current_generation(self):
+        """Increases on every clear(), in any worker with a shared tier"""
+        if self.shared is not None:
+            return self.shared.generation()
+        return self.generation
+
+    def get(self, key, version=None):
+        """The cached entry, None when missing or of another version"""
+        generation = self.current_generation()
+        if generation != self.seen_generation:
+            # Cleared by another worker, drop the old mappings
+            with self.lock:
+                self.entries.clear()
+                self.seen_generation = generation
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None and self.shared is not None:
+            entry = self._load(key, generation)
+        if entry is not None and entry.version != version:
+            return None
+        return entry
+
+    def _load(self, key, generation):
+        """Maps an entry another worker wrote to the shared tier"""
+        found = self.shared.read(key, generation)
+        if found is None:
+            return None
+
+        meta, sections = found
+        entry = CachedBody(sections.pop('identity'), meta['mimetype'],
+                           [tuple(header) for header in meta['headers']],
+                           meta['version'], (self.shared, key, generation))
+        entry.variants.update(sections)
+        with self.lock:
+            if generation == self.seen_generation:
+                self._store(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        """Adds an entry, dropping the least recently used ones over
+        max_entries. Call with the lock held
+        """
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def set(self, key, body, mimetype, generation=None, headers=None,
+            version=None):
+        """Stores a body unless the cache was cleared since generation was
+        read, so a response rendered before a write is never cached after it.
+        Concurrent misses of a key share the entry stored first, so its
+        variants are compressed once
+        :return: the entry to respond with
+        """
+        if generation is None:
+            generation = self.current_generation()
+
+        entry = CachedBody(body, mimetype, headers, version,
+                           (self.shared, key, generation)
+                           if self.shared is not None else None)
+        with self.lock:
+            if generation != self.current_generation():
+                return entry
+
+            stored = self.entries.get(key)
+            if stored is not None and stored.version == version:
+                return stored
+            self._store(key, entry)
+
+        # Compressed variants are added by the workers that serve them
+        entry.publish()
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+        if self.shared is not None:
+            self.shared.clear()
+
+    def key(self):
+        """The cache key of the current request. Parameter values are read
+        as comma separated sets, so '?fields=price,name' and
+        '?fields=name,price' share an entry
+        """
+        params = tuple(
+            (name, ','.join(sorted({value.strip() for value in
+                                    request.args[name].split(',')})))
+            for name in self.params if name in request.args)
+        return current_shard(), request.path, params
+
+    def cached(self, f):
+        """Decorator that serves successful responses of the view from the
+        cache, including their precompressed variants
+        """
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = self.key()
+            # Read before rendering, a write in between only costs a miss
+            version = self.version() if self.version else None
+            entry = self.get(key, version)
+
+            if entry is None:
+                generation = self.current_generation()
+                response = f(*args, **kwargs)
+                if not isinstance(response, Response) or \
+                        response.status_code != 200:
+                    return response
+
+                entry = self.set(key, response.get_data(), response.mimetype,
+                                 generation, [
+                                     (name, value) for name, value
+                                     in response.headers
+                                     if name in CACHED_HEADERS],
+                                 version)
+
+            return entry.respond(request.headers.get('Accept-Encoding'))
+
+        return wrapper
@@ -0,0 +1,155 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from contextlib import contextmanager
+
+SHARED_CACHE_DIR = os.environ.get('SHARED_CACHE_DIR')
+
+MAGIC = b'P4RC'
+# magic, generation & length of the JSON metadata
+HEADER = struct.Struct('<4sQI')
+COUNTER = struct.Struct('<Q')
+
+
+class SharedCache:
+    """Cache entries in memory-mapped files shared by every gunicorn worker
+    on the host, i.e. under /dev/shm. An entry is written once, by the
+    first worker that misses, and mapped read-only by the others, so the
+    host keeps one resident copy instead of one per worker.
+    Entries belong to a generation, a counter in a small mapped file that
+    clear() increments, so a write in one worker invalidates all of them
+    EXAMPLE
+        shared = SharedCache('/dev/shm/plants4rent', 'catalog')
+        shared.write('key', {'mimetype': 'application/json'},
+                     {'identity': body}, shared.generation())
+        meta, sections = shared.read('key', shared.generation())
+    """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.name = name
+        os.makedirs(directory, exist_ok=True)
+
+        self.lock_path = os.path.join(directory, f'{name}.lock')
+        control_path = os.path.join(directory, f'{name}.generation')
+        with self._locked():
+            fd = os.open(control_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size < COUNTER.size:
+                    os.ftruncate(fd, COUNTER.size)
+                self.control = mmap.mmap(fd, COUNTER.size)
+            finally:
+                os.close(fd)
+
+    @contextmanager
+    def _locked(self):
+        """Holds the host wide lock of the cache. The lock file is never
+        mapped and is opened on every call: flock belongs to the open file,
+        so it would stay held by an mmap of it, and is not exclusive between
+        processes sharing a descriptor inherited over fork (gunicorn
+        --preload)
+        """
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _path(self, key, generation):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory,
+                            f'{self.name}-{generation}-{digest}')
+
+    def generation(self):
+        """The current generation, read from shared memory without a
+        system call
+        """
+        return COUNTER.unpack_from(self.control)[0]
+
+    def clear(self):
+        """Starts a new generation and removes the entries of older ones.
+        Workers still holding an old mapping keep it valid until they drop it
+        """
+        with self._locked():
+            generation = self.generation() + 1
+            COUNTER.pack_into(self.control, 0, generation)
+
+        current = f'{self.name}-{generation}-'
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith(f'{self.name}-') and \
+                    not entry.name.startswith(current):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def read(self, key, generation):
+        """Maps the entry of the key written in the given generation
+        :return: tuple of the metadata dict and a dict of section names to
+        memoryviews into the mapping, or None when there is no such entry
+        """
+        try:
+            with open(self._path(key, generation), 'rb') as entry_file:
+                mapping = mmap.mmap(entry_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        magic, written, meta_size = HEADER.unpack_from(mapping)
+        if magic != MAGIC or written != generation:
+            return None
+
+        view = memoryview(mapping)
+        base = HEADER.size + meta_size
+        meta = json.loads(bytes(view[HEADER.size:base]))
+        sections = {name: view[base + start:base + start + size]
+                    for name, (start, size) in meta.pop('sections').items()}
+
+        return meta, sections
+
+    def write(self, key, meta, sections, generation):
+        """Writes an entry, replacing the file atomically so readers never
+        map a partial one. Entries of a generation that ended meanwhile are
+        dropped
+        :param meta: JSON serializable dict stored with the entry
+        :param sections: dict of section names to bytes
+        """
+        offset = 0
+        layout = {}
+        for name, data in sections.items():
+            layout[name] = [offset, len(data)]
+            offset += len(data)
+
+        # Section offsets are relative to the end of the metadata
+        encoded = json.dumps(dict(meta, sections=layout)).encode()
+
+        fd, temporary = tempfile.mkstemp(dir=self.directory,
+                                         prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as entry_file:
+                entry_file.write(HEADER.pack(MAGIC, generation, len(encoded)))
+                entry_file.write(encoded)
+                for data in sections.values():
+                    entry_file.write(data)
+
+            if generation != self.generation():
+                os.remove(temporary)
+                return
+            os.replace(temporary, self._path(key, generation))
+        except OSError:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+
+def shared_cache(name, directory=SHARED_CACHE_DIR):
+    """The SharedCache of the given name when a directory is set, else None
+    so callers keep their per-worker cache
+    """
+    if directory:
+        return SharedCache(directory, name)
+    return None
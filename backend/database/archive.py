@@ -0,0 +1,81 @@
+"""Moves closed rentals from 'Rented' to 'RentedArchive'.
+Run it periodically (i.e. nightly) so the hot 'Rented' table only keeps
+current and recently closed rentals
+EXAMPLE
+    python -m backend.database.archive --days 90
+"""
+
+import argparse
+import json
+from datetime import datetime, timedelta
+
+from backend.database.models import Event, Rented, RentedArchive, db
+from backend.database.shards import shard_keys, use_shard
+
+COLUMNS = ['id', 'plant_id', 'renter_id', 'plant_name', 'price', 'started_at',
+           'ended_at']
+
+
+def archive_closed_rentals(before, chunk_size=10000):
+    """Moves the rentals that ended before the given time to the archive.
+    Each chunk is copied and deleted in one transaction
+    :param before: datetime, rentals that ended earlier are archived
+    :param chunk_size: number of rentals moved per transaction
+    :return: number of rentals archived
+    """
+    rented = Rented.__table__
+    moved = 0
+
+    while True:
+        ids = [row.id for row in db.session.query(Rented.id)
+               .filter(Rented.ended_at < before)
+               .order_by(Rented.id)
+               .limit(chunk_size)]
+        if not ids:
+            return moved
+
+        chunk = (rented.c.id.between(ids[0], ids[-1])) & \
+                (rented.c.ended_at < before)
+        db.session.execute(RentedArchive.__table__.insert().from_select(
+            COLUMNS, db.select([rented.c[name] for name in COLUMNS])
+            .where(chunk)))
+        db.session.execute(rented.delete().where(chunk))
+        # One feed event per chunk, it also expires the cached invoices
+        db.session.add(Event(entity='rental', entity_id=ids[-1],
+                             action='archive', data=json.dumps({
+                                 'first_id': ids[0], 'last_id': ids[-1],
+                                 'ended_before': before.isoformat()})))
+        db.session.info['events'] = True
+        db.session.commit()
+
+        moved += len(ids)
+
+
+def archive_every_shard(app, before, chunk_size=10000):
+    """Archives the closed rentals of the default database and of every
+    tenant shard
+    :param app: the Flask app, with its shards set up
+    :return: dict of bind key (None for the default database) to the
+    number of rentals archived
+    """
+    counts = {}
+    for shard in [None] + shard_keys(app):
+        with app.app_context():
+            use_shard(shard)
+            counts[shard] = archive_closed_rentals(before, chunk_size)
+    return counts
+
+
+if __name__ == '__main__':
+    from backend.app import app
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=int, default=90,
+                        help='archive rentals closed more than DAYS ago')
+    args = parser.parse_args()
+
+    counts = archive_every_shard(
+        app, datetime.utcnow() - timedelta(days=args.days))
+    for shard, count in counts.items():
+        print(f'Archived {count} rentals from {shard or "the default"} '
+              'database')
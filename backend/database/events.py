@@ -0,0 +1,102 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func
+
+from backend.database.models import Event, db
+from backend.database.shards import RoutingSession
+
+EVENTS_MAX_WAIT = float(os.environ.get('EVENTS_MAX_WAIT', 30))
+EVENTS_POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 1))
+EVENTS_GAP_TIMEOUT = float(os.environ.get('EVENTS_GAP_TIMEOUT', 5))
+EVENTS_STREAM_TIMEOUT = float(os.environ.get('EVENTS_STREAM_TIMEOUT', 300))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+
+# Wakes waiting readers as soon as this process commits events. Events
+# committed by other gunicorn workers are found by polling
+_committed = threading.Condition()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def notify_readers(session):
+    if session.info.pop('events', False):
+        with _committed:
+            _committed.notify_all()
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_events(session):
+    session.info.pop('events', None)
+
+
+def catalog_version():
+    """Seq of the latest plant event, changes with every catalog write made
+    by any worker. Versions the cached catalog
+    """
+    return db.session.query(func.max(Event.seq)) \
+        .filter(Event.entity == 'plant').scalar()
+
+
+def read_events(after, limit):
+    """Events with a seq greater than after, oldest first.
+    A transaction that committed after one holding a lower seq can make the
+    lower seq show up late. Events are returned up to such a gap, unless the
+    gap is older than EVENTS_GAP_TIMEOUT and so a rolled back transaction
+    :param after: last seq the consumer has seen, 0 for the whole log
+    :param limit: maximum number of events
+    :return: list of Event
+    """
+    events = Event.query.filter(Event.seq > after) \
+        .order_by(Event.seq).limit(limit).all()
+
+    settled = datetime.utcnow() - timedelta(seconds=EVENTS_GAP_TIMEOUT)
+    expected = after + 1
+    for index, change in enumerate(events):
+        if change.seq != expected and change.created_at > settled:
+            return events[:index]
+        expected = change.seq + 1
+
+    return events
+
+
+def wait_for_events(after, limit, timeout=0):
+    """Long-polls for events with a seq greater than after
+    :param timeout: seconds to wait when there are no events yet
+    :return: list of Event, empty when none arrived in time
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        events = read_events(after, limit)
+        remaining = deadline - time.monotonic()
+        if events or remaining <= 0:
+            return events
+
+        # End the read transaction so the next read sees new commits
+        db.session.rollback()
+        with _committed:
+            _committed.wait(min(remaining, EVENTS_POLL_INTERVAL))
+
+
+def stream_events(after, limit, timeout=EVENTS_STREAM_TIMEOUT):
+    """Server-Sent Events of the feed, with a comment line every
+    EVENTS_HEARTBEAT seconds to keep proxies from closing the connection.
+    The stream ends after timeout seconds; clients reconnect with the
+    Last-Event-ID header to continue where they left off
+    :return: generator of SSE messages
+    """
+    deadline = time.monotonic() + timeout
+    yield f'retry: {int(EVENTS_POLL_INTERVAL * 1000)}\n\n'
+
+    while time.monotonic() < deadline:
+        events = wait_for_events(after, limit, EVENTS_HEARTBEAT)
+        if not events:
+            yield ': heartbeat\n\n'
+            continue
+
+        for change in events:
+            yield f'id: {change.seq}\n' \
+                  f'data: {json.dumps(change.values())}\n\n'
+        after = events[-1].seq
@@ -1,12 +1,17 @@
 import os
-from sqlalchemy import Column, String, Integer, Float
-from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+from sqlalchemy import Column, String, Integer, Float, Text, DateTime, \
+    event
+from sqlalchemy.exc import IntegrityError
 import json
 
+from backend.database.shards import RoutingSession, ShardedSQLAlchemy, \
+    shard_keys
+
 database_name = os.environ.get('DATABASE_NAME')
 database_path = os.environ.get('DATABASE_PATH')
 
-db = SQLAlchemy()
+db = ShardedSQLAlchemy()
 
 
 def setup_db(app, database_path):
@@ -17,6 +22,16 @@ def setup_db(app, database_path):
     db.init_app(app)
 
 
+def select_fields(model, fields):
+    """Query of only the given columns of a model, for sparse fieldsets.
+    Rows are plain tuples, use row._asdict() to serialise them
+    EXAMPLE
+        rows = select_fields(Catalog, ('id', 'name')).all()
+        plants = [row._asdict() for row in rows]
+    """
+    return db.session.query(*[getattr(model, field) for field in fields])
+
+
 def db_drop_and_create_all():
     """Drops the database tables and starts fresh
     can be used to initialize a clean database
@@ -26,6 +41,12 @@ def db_drop_and_create_all():
     db.drop_all()
     db.create_all()
 
+    # Tenant shards hold the same tables as the default database
+    for shard in shard_keys(db.get_app()):
+        engine = db.get_engine(bind=shard)
+        db.Model.metadata.drop_all(bind=engine)
+        db.Model.metadata.create_all(bind=engine)
+
 # TODO: apply Cascades to all models for better data cleanup on delete
 # https://docs.sqlalchemy.org/en/13/orm/cascades.html
 class Catalog(db.Model):
@@ -33,15 +54,21 @@ class Catalog(db.Model):
     Extends the base SQLAlchemy Model
     """
     __tablename__ = 'Catalog'
+    SHORT_FIELDS = ('id', 'name', 'description')
+    LONG_FIELDS = ('id', 'name', 'description', 'quantity', 'price')
 
     id = Column(Integer, primary_key=True)
     name = Column(String(), unique=True)
     description = Column(String(), nullable=False)
     quantity = Column(Integer, nullable=False)
     price = Column(Float, nullable=False)
+    version_id = Column(Integer, nullable=False, default=1)
 
     renters = db.relationship('Rented', backref='Catalog', lazy=True)
 
+    # ORM updates and deletes check the version they loaded is still current
+    __mapper_args__ = {'version_id_col': version_id}
+
     def short(self):
         """Short form representation of the Catalog model"""
 
@@ -97,6 +124,51 @@ class Catalog(db.Model):
         """
         db.session.commit()
 
+    @classmethod
+    def update_fields(cls, plant_id, values, version=None):
+        """Updates the given columns with a single UPDATE ... WHERE id
+        [AND version_id] statement, without loading the plant first. Returns
+        the updated row in the same round trip where the database supports
+        RETURNING
+        EXAMPLE
+            plant = Catalog.update_fields(plant_id, {'price': 4.97},
+                version=3)
+        :param plant_id: integer id of the plant
+        :param values: dict of column names to new values
+        :param version: version_id the caller last saw, or a list of the
+        version_ids it accepts, None to skip the check
+        :return: dict of the long form fields & 'version_id', or None when no
+        row matched
+        """
+        table = cls.__table__
+        condition = table.c.id == plant_id
+        if isinstance(version, (list, tuple, set)):
+            condition &= table.c.version_id.in_(version)
+        elif version is not None:
+            condition &= table.c.version_id == version
+
+        statement = table.update().where(condition) \
+            .values(version_id=table.c.version_id + 1, **values)
+        columns = [table.c[field]
+                   for field in cls.LONG_FIELDS + ('version_id',)]
+
+        if db.session.get_bind().dialect.implicit_returning:
+            row = db.session.execute(statement.returning(*columns)).first()
+        else:
+            row = None
+            if db.session.execute(statement).rowcount:
+                row = db.session.execute(db.select(columns).where(
+                    table.c.id == plant_id)).first()
+        if row:
+            # Core statements bypass the flush listener, record it here
+            data = {field: row[field] for field in cls.LONG_FIELDS}
+            db.session.add(Event(entity='plant', entity_id=plant_id,
+                                 action='update', data=json.dumps(data)))
+            db.session.info['events'] = True
+        db.session.commit()
+
+        return dict(row) if row else None
+
     def __repr__(self):
         return json.dumps(self.short())
 
@@ -106,12 +178,15 @@ class Renter(db.Model):
     Extends the base SQLAlchemy Model
     """
     __tablename__ = 'Renter'
+    SHORT_FIELDS = ('id', 'name')
+    LONG_FIELDS = ('id', 'name', 'address', 'city', 'state')
 
     id = Column(Integer, primary_key=True)
+    # The unique constraint also gives lookups by name an index
     name = Column(String(), unique=True)
     address = Column(String(), nullable=False)
     city = Column(String(), nullable=False)
-    state = Column(String(), nullable=False)
+    state = Column(String(), nullable=False, index=True)
 
     plants = db.relationship('Rented', backref='Renter', lazy=True)
 
@@ -170,19 +245,94 @@ class Renter(db.Model):
         """
         db.session.commit()
 
+    @classmethod
+    def bulk_insert(cls, renters, chunk_size=500):
+        """Inserts many renters, one transaction per chunk. Renters whose
+        name already exists, in the database or earlier in the list, are
+        skipped instead of failing the chunk
+        EXAMPLE
+            created, conflicts = Renter.bulk_insert([{'name': req_name,
+                'address': req_addr, 'city': req_city, 'state': req_state}])
+        :param renters: list of dicts with the long form fields but 'id'
+        :param chunk_size: number of renters inserted per transaction
+        :return: tuple of the number created and the list of skipped names
+        """
+        table = cls.__table__
+        created = 0
+        conflicts = []
+
+        for offset in range(0, len(renters), chunk_size):
+            chunk = renters[offset:offset + chunk_size]
+
+            for attempt in range(2):
+                names = [renter['name'] for renter in chunk]
+                existing = {name for name, in db.session.query(cls.name)
+                            .filter(cls.name.in_(names))}
+                rows = []
+                skipped = []
+                for renter in chunk:
+                    if renter['name'] in existing:
+                        skipped.append(renter['name'])
+                    else:
+                        existing.add(renter['name'])
+                        rows.append(renter)
+
+                try:
+                    if rows:
+                        db.session.execute(table.insert(), rows)
+                    db.session.commit()
+                    break
+                except IntegrityError:
+                    # A concurrent insert took a name, look them up again
+                    db.session.rollback()
+                    if attempt:
+                        raise
+
+            created += len(rows)
+            conflicts.extend(skipped)
+
+        return created, conflicts
+
     def __repr__(self):
         return json.dumps(self.short())
 
 
+def plant_snapshot(column):
+    """Column default copying a column of the rented plant from 'Catalog'
+    when the rental is inserted, so later catalog changes do not alter it
+    :param column: name of the Catalog column (i.e. 'price')
+    """
+    catalog = Catalog.__table__
+
+    def default(context):
+        plant_id = context.get_current_parameters()['plant_id']
+        return context.connection.execute(
+            db.select([catalog.c[column]]).where(catalog.c.id == plant_id)
+        ).scalar()
+
+    return default
+
+
 class Rented(db.Model):
     """A persistent plant 'Rented' entity.
+    The plant name & price are snapshotted when the rental is created, so
+    invoices are aggregated from this table alone.
     Extends the base SQLAlchemy Model
     """
     __tablename__ = 'Rented'
+    __table_args__ = (
+        db.Index('ix_Rented_renter_id_started_at', 'renter_id',
+                 'started_at'),
+    )
 
     id = Column(Integer, primary_key=True)
     plant_id = Column(Integer, db.ForeignKey('Catalog.id'), nullable=False)
     renter_id = Column(Integer, db.ForeignKey('Renter.id'), nullable=False)
+    plant_name = Column(String(), nullable=False,
+                        default=plant_snapshot('name'))
+    price = Column(Float, nullable=False, default=plant_snapshot('price'))
+    started_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    ended_at = Column(DateTime, index=True)
 
     def values(self):
         """Representation of the Rented model"""
@@ -191,12 +341,28 @@ class Rented(db.Model):
             'id': self.id,
             'plant_id': self.plant_id,
             'renter_id': self.renter_id,
+            'plant_name': self.plant_name,
+            'price': self.price,
+            'started_at': self.started_at.isoformat()
+            if self.started_at else None,
+            'ended_at': self.ended_at.isoformat() if self.ended_at else None
         }
 
+    def end(self, ended_at=None):
+        """Ends the rental. Closed rentals are moved to RentedArchive by
+        backend/database/archive.py
+        EXAMPLE
+            rented = Rented.query.get(rented_id)
+            rented.end()
+        """
+        self.ended_at = ended_at or datetime.utcnow()
+        db.session.commit()
+
     def insert(self):
         """Inserts a new model into a database
         the model must have a plant id
         the model must have a renter id
+        the plant name & price default to the plant's current ones
         EXAMPLE
             rented = Rented(plant_id=req_plant_id, renter_id=req_renter_id)
             rented.insert()
@@ -226,3 +392,242 @@ class Rented(db.Model):
 
     def __repr__(self):
         return json.dumps(self.short())
+
+
+class RentedArchive(db.Model):
+    """Closed rentals moved out of the 'Rented' table so queries on current
+    rentals only touch recent rows. Only read by period invoices.
+    Extends the base SQLAlchemy Model
+    """
+    __tablename__ = 'RentedArchive'
+    __table_args__ = (
+        db.Index('ix_RentedArchive_renter_id_started_at', 'renter_id',
+                 'started_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    plant_id = Column(Integer, nullable=False)
+    renter_id = Column(Integer, nullable=False)
+    plant_name = Column(String(), nullable=False)
+    price = Column(Float, nullable=False)
+    started_at = Column(DateTime, nullable=False)
+    ended_at = Column(DateTime, nullable=False, index=True)
+
+    def values(self):
+        """Representation of the RentedArchive model"""
+
+        return {
+            'id': self.id,
+            'plant_id': self.plant_id,
+            'renter_id': self.renter_id,
+            'plant_name': self.plant_name,
+            'price': self.price,
+            'started_at': self.started_at.isoformat(),
+            'ended_at': self.ended_at.isoformat()
+        }
+
+    def __repr__(self):
+        return json.dumps(self.values())
+
+
+class Report(db.Model):
+    """A persistent background 'Report' job entity.
+    Extends the base SQLAlchemy Model
+    """
+    __tablename__ = 'Report'
+
+    id = Column(String(32), primary_key=True)
+    kind = Column(String(), nullable=False)
+    params = Column(Text, nullable=False, default='{}')
+    status = Column(String(), nullable=False, default='queued')
+    result = Column(Text)
+    permission = Column(String(), nullable=False)
+    subject = Column(String())
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+    def short(self):
+        """Short form representation of the Report model"""
+
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+        }
+
+    def long(self):
+        """Long form representation of the Report model"""
+
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'params': json.loads(self.params),
+            'status': self.status,
+            'result': json.loads(self.result) if self.result else None,
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at.isoformat()
+            if self.finished_at else None
+        }
+
+    def insert(self):
+        """Inserts a new model into a database
+        the model must have an id
+        the model must have a kind
+        the model must have a permission
+        EXAMPLE
+            report = Report(id=uuid4().hex, kind='rented',
+                permission='get:rented')
+            report.insert()
+        """
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        """Deletes a new model from a database
+        the model must exist in the database
+        EXAMPLE
+            report = Report.query.get(report_id)
+            report.delete()
+        """
+        db.session.delete(self)
+        db.session.commit()
+
+    def update(self):
+        """Updates a new model into a database
+        the model must exist in the database
+        EXAMPLE
+            report = Report.query.get(report_id)
+            report.status = 'done'
+            report.update()
+        """
+        db.session.commit()
+
+    def __repr__(self):
+        return json.dumps(self.short())
+
+
+class IdempotencyKey(db.Model):
+    """A persistent 'IdempotencyKey' entity recording the response of a write
+    so retries carrying the same Idempotency-Key header can be replayed.
+    Extends the base SQLAlchemy Model
+    """
+    __tablename__ = 'IdempotencyKey'
+
+    id = Column(String(64), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(Integer)
+    body = Column(Text)
+    # JSON list of the [name, value] response headers sent on replay
+    headers = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow,
+                        index=True)
+
+    def short(self):
+        """Short form representation of the IdempotencyKey model"""
+
+        return {
+            'id': self.id,
+            'status_code': self.status_code,
+        }
+
+    def insert(self):
+        """Inserts a new model into a database
+        the model must have a unique id
+        the model must have a fingerprint
+        EXAMPLE
+            record = IdempotencyKey(id=scoped_key, fingerprint=digest)
+            record.insert()
+        """
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        """Deletes a new model from a database
+        the model must exist in the database
+        EXAMPLE
+            record = IdempotencyKey.query.get(scoped_key)
+            record.delete()
+        """
+        db.session.delete(self)
+        db.session.commit()
+
+    def update(self):
+        """Updates a new model into a database
+        the model must exist in the database
+        EXAMPLE
+            record = IdempotencyKey.query.get(scoped_key)
+            record.status_code = 200
+            record.update()
+        """
+        db.session.commit()
+
+    def __repr__(self):
+        return json.dumps(self.short())
+
+
+class Event(db.Model):
+    """A persistent 'Event' entity of the append-only change feed. Events
+    are written in the same transaction as the Catalog or Rented change
+    they record, by the flush listener below.
+    Extends the base SQLAlchemy Model
+    """
+    __tablename__ = 'Event'
+    __table_args__ = (
+        db.Index('ix_Event_entity_seq', 'entity', 'seq'),
+    )
+
+    seq = Column(Integer, primary_key=True)
+    entity = Column(String(), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    action = Column(String(), nullable=False)
+    data = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def values(self):
+        """Representation of the Event model"""
+
+        return {
+            'seq': self.seq,
+            'entity': self.entity,
+            'entity_id': self.entity_id,
+            'action': self.action,
+            'data': json.loads(self.data),
+            'created_at': self.created_at.isoformat()
+        }
+
+    def __repr__(self):
+        return json.dumps(self.values())
+
+
+# ---------------------------------------------------------------------------
+# Change feed
+# ---------------------------------------------------------------------------
+
+# Models recorded in the change feed: entity name & representation
+EVENT_ENTITIES = {
+    Catalog: ('plant', Catalog.long),
+    Rented: ('rental', Rented.values)
+}
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def record_events(session, flush_context):
+    """Adds an Event for every Catalog and Rented row inserted, updated or
+    deleted by the flush. The events are flushed again before the commit,
+    so they land in the same transaction as the changes
+    """
+    changes = [(instance, 'insert') for instance in session.new] + \
+        [(instance, 'update') for instance in session.dirty
+         if session.is_modified(instance, include_collections=False)] + \
+        [(instance, 'delete') for instance in session.deleted]
+
+    for instance, action in changes:
+        entity = EVENT_ENTITIES.get(type(instance))
+        if entity is None:
+            continue
+
+        name, represent = entity
+        session.add(Event(entity=name, entity_id=instance.id, action=action,
+                          data=json.dumps(represent(instance))))
+        session.info['events'] = True
+
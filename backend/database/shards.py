@@ -0,0 +1,112 @@
+import json
+import os
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+
+SHARD_MAP = os.environ.get('SHARD_MAP')
+TENANT_CLAIM = os.environ.get('TENANT_CLAIM', 'tenant')
+# Tenant of the JWTs without a tenant claim, refused when unset
+DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT')
+
+
+def load_shard_map(value=SHARD_MAP):
+    """Reads the shard map, a JSON object of tenant names to database URIs,
+    given inline or as the path of a JSON file
+    EXAMPLE
+        SHARD_MAP='{"north": "postgres://localhost:5432/plants_north",
+                    "south": "postgres://localhost:5432/plants_south"}'
+    :return: dict of tenant to database URI, empty when not configured
+    """
+    if not value:
+        return {}
+    if value.lstrip().startswith('{'):
+        return json.loads(value)
+    with open(value) as shard_file:
+        return json.load(shard_file)
+
+
+def setup_shards(app, shard_map, default_tenant=DEFAULT_TENANT):
+    """Registers one bind, and so one engine and connection pool, per
+    tenant in the shard map. The tables have no tenant column, so every
+    tenant needs a database of its own
+    :param app: the Flask app, after setup_db
+    :param shard_map: dict of tenant to database URI
+    :param default_tenant: tenant of the requests that name none, None to
+    refuse authenticated ones and send public ones to the default database
+    """
+    owners = {}
+    for tenant, uri in shard_map.items():
+        if uri in owners:
+            raise ValueError(f'Tenants {owners[uri]} and {tenant} share a '
+                             'database, their data would mix')
+        owners[uri] = tenant
+
+    if default_tenant is not None and default_tenant not in shard_map:
+        raise ValueError(f'Default tenant {default_tenant} is not in the '
+                         'shard map')
+
+    tenants = {tenant: f'shard:{index}'
+               for index, tenant in enumerate(shard_map)}
+    app.config['SQLALCHEMY_BINDS'] = {tenants[tenant]: uri
+                                      for tenant, uri in shard_map.items()}
+    app.config['TENANT_SHARDS'] = tenants
+    app.config['DEFAULT_TENANT'] = default_tenant
+
+
+def shard_for(app, tenant, required=False):
+    """The bind key of the tenant's shard. Requests without a tenant go to
+    the default tenant when one is configured
+    :param required: raise a KeyError instead of returning None when
+    sharding is on and there is no tenant
+    :return: the bind key, None for no tenant or when sharding is off.
+    Raises KeyError for tenants missing from the shard map
+    """
+    shards = app.config.get('TENANT_SHARDS')
+    if not shards:
+        return None
+
+    if tenant is None:
+        tenant = app.config.get('DEFAULT_TENANT')
+    if tenant is None:
+        if required:
+            raise KeyError(tenant)
+        return None
+    return shards[tenant]
+
+
+def use_shard(shard):
+    """Routes the queries of the current app context to the shard"""
+    g.shard = shard
+
+
+def current_shard():
+    """The bind key the current app context is routed to, None for the
+    default database
+    """
+    if has_app_context():
+        return g.get('shard')
+    return None
+
+
+def shard_keys(app):
+    """Bind keys of all configured shards"""
+    return sorted(app.config.get('SQLALCHEMY_BINDS') or {})
+
+
+class RoutingSession(SignallingSession):
+    """Session sending every statement to the current tenant's shard"""
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = current_shard()
+        if shard is not None:
+            return get_state(self.app).db.get_engine(self.app, bind=shard)
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy service whose sessions use the RoutingSession"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -7,12 +7,49 @@ FLASK_DEBUG=1
 AUTH0_DOMAIN="thedevscott.auth0.com"
 ALGORITHMS="RS256"
 API_AUDIENCE="rentPlants"
+# 'remote' (Auth0), 'file' (JWKS_FILE) or 'local' (AUTH_SECRET)
+AUTH_KEY_PROVIDER="remote"
+JWKS_CACHE_TTL=600
 
 # Database setup
 DATABASE_NAME="plant_catalog"
 DATABASE_HOST="localhost:5432"
 DATABASE_PATH="postgres://localhost:5432/plant_catalog"
 
+# Rate limiting. RATE_LIMIT_STORE shares buckets between gunicorn workers
+RATE_LIMIT_RATE=5
+RATE_LIMIT_BURST=20
+RATE_LIMIT_CONCURRENCY=8
+RATE_LIMIT_STORE="/tmp/plants4rent_ratelimit.db"
+
+# Profiling, disabled unless PROFILE_DIR is set
+PROFILE_DIR="/tmp/plants4rent_profiles"
+PROFILE_MODE="sample"
+PROFILE_SAMPLE_RATE=0
+PROFILE_KEEP=100
+
+# Responses kept per cache, least recently used first out
+CACHE_MAX_ENTRIES=1024
+# gzip level of cached responses, brotli quality is this + 2
+CACHE_COMPRESSION_LEVEL=6
+
+# Background reports
+REPORT_WORKERS=2
+REPORT_TIMEOUT=600
+
+# Cache shared by the gunicorn workers of a host, per worker when unset
+SHARED_CACHE_DIR="/dev/shm/plants4rent"
+
+# Change feed (GET /events) long-polling and Server-Sent Events
+EVENTS_MAX_WAIT=30
+EVENTS_POLL_INTERVAL=1
+EVENTS_STREAM_TIMEOUT=300
+
+# Structured JSON logs, LOG_SAMPLE_RATES samples successful requests per route
+LOG_LEVEL="INFO"
+LOG_QUEUE_SIZE=10000
+LOG_SAMPLE_RATES="/=0.01,/plants=0.01"
+
 # For test_app.py
 RENTER_TOKEN="<VALID_JWT>"
 OWNER_TOKEN="<VALID_JWT>"
@@ -0,0 +1,119 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from backend.database.models import Report, db
+from backend.database.shards import current_shard, use_shard
+
+REPORT_WORKERS = int(os.environ.get('REPORT_WORKERS', 2))
+# Seconds after which an unfinished report of another worker is failed
+REPORT_TIMEOUT = float(os.environ.get('REPORT_TIMEOUT', 600))
+
+
+class JobQueue:
+    """Runs report jobs on a local worker pool outside of the request.
+    Job status and results are stored as Report rows, so any gunicorn worker
+    can answer GET /reports/<id> for a job enqueued by another one
+    EXAMPLE
+        jobs = JobQueue(app)
+        jobs.register('rented', build_rented)
+        report = jobs.enqueue('rented', 'get:rented', jwt['sub'])
+    """
+
+    def __init__(self, app=None, workers=REPORT_WORKERS,
+                 timeout=REPORT_TIMEOUT):
+        self.app = app
+        self.workers = workers
+        self.timeout = timeout
+        self.handlers = {}
+        self.executor = None
+        # Ids of the reports queued or running in this process
+        self.pending = set()
+
+    def init_app(self, app):
+        self.app = app
+
+    def register(self, kind, handler):
+        """Registers the function that computes a kind of report
+        :param kind: name of the report (i.e. 'rented')
+        :param handler: function returning a JSON serializable result
+        """
+        self.handlers[kind] = handler
+
+    def enqueue(self, kind, permission, subject, **params):
+        """Stores a queued Report and schedules it on the worker pool
+        :param kind: a registered report kind
+        :param permission: permission required to read the report
+        :param subject: JWT 'sub' of the caller that owns the report
+        :param params: keyword arguments passed to the handler
+        :return: the queued Report
+        """
+        if kind not in self.handlers:
+            raise KeyError(kind)
+
+        report = Report(id=uuid4().hex, kind=kind, params=json.dumps(params),
+                        status='queued', permission=permission,
+                        subject=subject)
+        report.insert()
+
+        if self.executor is None:
+            # Started lazily so the pool is created after gunicorn forks
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix='report')
+        self.pending.add(report.id)
+        self.executor.submit(self._run, report.id, current_shard())
+
+        return report
+
+    def _run(self, report_id, shard=None):
+        """Computes a report inside its own app context and db session,
+        routed to the shard of the tenant that queued it
+        """
+        with self.app.app_context():
+            use_shard(shard)
+            try:
+                report = Report.query.get(report_id)
+                report.status = 'running'
+                report.update()
+
+                try:
+                    result = self.handlers[report.kind](
+                        **json.loads(report.params))
+                    report.result = json.dumps(result)
+                    report.status = 'done'
+                except Exception as e:
+                    db.session.rollback()
+                    report.result = json.dumps({'message': str(e)})
+                    report.status = 'failed'
+
+                report.finished_at = datetime.utcnow()
+                report.update()
+            finally:
+                self.pending.discard(report_id)
+                db.session.remove()
+
+    def expire(self, report):
+        """Fails a report left queued or running by a worker that restarted,
+        i.e. one unfinished after timeout seconds that this process does not
+        run. Called when the report is polled
+        :param report: Report to check
+        :return: the report
+        """
+        deadline = datetime.utcnow() - timedelta(seconds=self.timeout)
+        if report.status in ('queued', 'running') and \
+                report.id not in self.pending and \
+                report.created_at < deadline:
+            report.result = json.dumps({
+                'message': 'The report did not finish, queue it again'})
+            report.status = 'failed'
+            report.finished_at = datetime.utcnow()
+            report.update()
+
+        return report
+
+    def shutdown(self, wait=True):
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.executor = None
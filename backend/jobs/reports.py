@@ -0,0 +1,148 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import func, or_
+
+from backend.database.models import Event, Rented, RentedArchive, Renter, \
+    db
+
+
+def parse_datetime(value):
+    """Parses an ISO 8601 date or datetime into the naive UTC the columns
+    hold. A 'Z' suffix or an offset is converted to UTC, None is passed
+    through. Raises a ValueError for anything else
+    EXAMPLE
+        parse_datetime('2020-01-01T08:00:00+02:00')  # 2020-01-01 06:00
+    """
+    if value is None:
+        return value
+    if not isinstance(value, datetime):
+        # fromisoformat only reads 'Z' from Python 3.11 on
+        if value[-1:] in ('Z', 'z'):
+            value = value[:-1] + '+00:00'
+        value = datetime.fromisoformat(value)
+
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def rentals_version():
+    """Seq of the latest rental event, changes whenever a rental is created,
+    ended, deleted or archived. Versions the cached invoices
+    """
+    return db.session.query(func.max(Event.seq)) \
+        .filter(Event.entity == 'rental').scalar()
+
+
+def _invoice_lines(model, renter_id, start, end):
+    """Counts the rentals of a renter per plant & rented price, grouped in
+    the database. Reads the prices snapshotted on the rentals, not the
+    catalog
+    :param model: Rented or RentedArchive
+    :return: query of (plant name, plant price, rental count) rows
+    """
+    query = db.session.query(model.plant_name, model.price,
+                             func.count(model.id)) \
+        .filter(model.renter_id == renter_id)
+
+    # Without a period, the current (not ended) rentals
+    if start is None and end is None:
+        query = query.filter(model.ended_at.is_(None))
+
+    # Rentals overlapping [start, end)
+    if end is not None:
+        query = query.filter(model.started_at < end)
+    if start is not None:
+        query = query.filter(or_(model.ended_at.is_(None),
+                                 model.ended_at >= start))
+
+    return query.group_by(model.plant_name, model.price)
+
+
+def build_invoice(renter_id, start=None, end=None):
+    """Aggregates the rentals of a renter into an invoice.
+    Without a period the current (not ended) rentals are invoiced, so
+    archiving ended ones does not change it. A period also reads
+    'RentedArchive' when archived rentals can fall inside it
+    :param renter_id: integer id of the renter
+    :param start: optional start of the period (datetime or ISO 8601)
+    :param end: optional end of the period, exclusive
+    :return: dict with keys 'invoice' (None when nothing is rented) & 'total'
+    """
+    start = parse_datetime(start)
+    end = parse_datetime(end)
+
+    sources = [Rented]
+    if start is not None or end is not None:
+        archived_until = db.session.query(
+            func.max(RentedArchive.ended_at)).scalar()
+        if archived_until is not None and \
+                (start is None or archived_until >= start):
+            sources.append(RentedArchive)
+
+    # Build the invoice
+    invoice = {}
+    total = 0.0
+
+    for model in sources:
+        for plant_name, plant_price, count in _invoice_lines(
+                model, renter_id, start, end):
+            total += plant_price * count
+
+            if plant_name not in invoice:
+                invoice[plant_name] = {
+                    'count': count,
+                    'price': plant_price * count
+                }
+            else:
+                invoice[plant_name]['count'] += count
+                invoice[plant_name]['price'] += plant_price * count
+
+    return {
+        'invoice': invoice or None,
+        'total': total
+    }
+
+
+def build_rented():
+    """Aggregates the current (not ended) rentals per client and plant
+    :return: dict with key 'data' (None when nothing is rented)
+    """
+    results = db.session.query(Renter.name, Rented.plant_name, Rented.price,
+                               func.count(Rented.id)) \
+        .join(Renter, Renter.id == Rented.renter_id) \
+        .filter(Rented.ended_at.is_(None)) \
+        .group_by(Renter.id, Renter.name, Rented.plant_name, Rented.price) \
+        .all()
+    data = {}
+
+    if not results:
+        return {
+            'data': None
+        }
+
+    for client_name, plant_name, plant_price, count in results:
+        price = plant_price * count
+
+        # New client entry
+        if client_name not in data:
+            # Make dict for this clients plants
+            data[client_name] = {}
+            data[client_name]['total'] = price
+        else:
+            data[client_name]['total'] += price
+
+        # The same plant may have been rented at different prices
+        if plant_name not in data[client_name]:
+            data[client_name][plant_name] = {
+                'name': plant_name,
+                'count': count,
+                'price': price
+            }
+        else:
+            data[client_name][plant_name]['count'] += count
+            data[client_name][plant_name]['price'] += price
+
+    return {
+        'data': data
+    }
@@ -1,6 +1,7 @@
 """Simple helper script for loading DB elements"""
 
 import random
+from datetime import datetime, timedelta
 
 from backend.app import app
 from backend.database.models import Catalog, Rented, Renter, setup_db, \
@@ -109,8 +110,10 @@ def go():
     for i in range(1, 80):
         plant_num = random.choice(range(1, len(plants)))
         renter_num = random.choice(range(1, len(renters) + 1))
+        started_at = datetime.utcnow() - timedelta(days=random.randint(0, 90))
         plant = Rented(plant_id=plant_num,
-                       renter_id=renter_num
+                       renter_id=renter_num,
+                       started_at=started_at
                        )
         plant.insert()
 
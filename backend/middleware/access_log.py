@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.exceptions import HTTPException
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Share of successful requests logged per route, i.e. '/plants=0.01'
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', '')
+
+access_logger = logging.getLogger('plants4rent.access')
+error_logger = logging.getLogger('plants4rent.error')
+
+
+def parse_sample_rates(value):
+    """Reads comma separated route=rate pairs
+    EXAMPLE
+        parse_sample_rates('/=0.01,/plants=0.01')
+    :return: dict of route rule to the share of requests logged
+    """
+    rates = {}
+    for pair in value.split(','):
+        route, _, rate = pair.strip().rpartition('=')
+        if route:
+            rates[route] = float(rate)
+    return rates
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, with the dict passed as
+    extra={'fields': {...}} merged in
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(record.created).isoformat()
+            + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class _Listener(QueueListener):
+    """QueueListener that waits for room in a full queue when stopped"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class AsyncLogHandler(QueueHandler):
+    """Hands records to a background thread that formats and writes them,
+    so log I/O never runs on the request thread. The queue is bounded and
+    records are dropped, and counted, when it is full instead of blocking
+    EXAMPLE
+        handler = AsyncLogHandler(logging.StreamHandler(sys.stdout))
+        logging.getLogger('plants4rent.access').addHandler(handler)
+    """
+
+    def __init__(self, target, maxsize=LOG_QUEUE_SIZE):
+        super().__init__(queue.Queue(maxsize))
+        self.target = target
+        self.dropped = 0
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def _start(self):
+        # Started lazily so the thread runs in the gunicorn worker, threads
+        # do not survive the fork of a preloaded app
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue(self.queue.maxsize)
+                self.listener = _Listener(self.queue, self.target,
+                                         respect_handler_level=True)
+                self.listener.start()
+                self.pid = os.getpid()
+
+    def prepare(self, record):
+        # Formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Waits until the queued records are written"""
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.queries = g.get('queries', 0) + 1
+
+
+def log_exception(error):
+    """Logs an exception a route turned into an error response. HTTP errors
+    raised on purpose, i.e. by get_or_404, are not logged
+    """
+    if isinstance(error, HTTPException):
+        return
+
+    error_logger.error('%s failed', request.endpoint, exc_info=error,
+                       extra={'fields': {
+                           'route': request.url_rule.rule
+                           if request.url_rule else None,
+                           'method': request.method,
+                           'sub': g.get('sub'),
+                           'error': type(error).__name__
+                       }})
+
+
+def setup_logging(app, sample_rates=LOG_SAMPLE_RATES):
+    """Writes a structured JSON access log line per request (route, status,
+    latency, query count, auth outcome & JWT 'sub') and the errors of the
+    routes to stdout through an AsyncLogHandler. Successful requests of a
+    route are logged at its LOG_SAMPLE_RATES rate (default all), failed
+    ones always
+    """
+    app.config['LOG_SAMPLE_RATES'] = parse_sample_rates(sample_rates)
+
+    target = logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter())
+    handler = AsyncLogHandler(target)
+    for logger in (access_logger, error_logger):
+        logger.setLevel(LOG_LEVEL)
+        logger.addHandler(handler)
+        logger.propagate = False
+
+    @app.before_request
+    def start_timer():
+        g.started = time.perf_counter()
+        g.queries = 0
+
+    @app.after_request
+    def log_request(response):
+        route = request.url_rule.rule if request.url_rule else None
+        rate = app.config['LOG_SAMPLE_RATES'].get(route, 1.0)
+        if response.status_code < 400 and rate < 1.0 and \
+                random.random() >= rate:
+            return response
+
+        started = g.get('started')
+        access_logger.info('%s %s %s', request.method, request.path,
+                           response.status_code, extra={'fields': {
+                               'route': route,
+                               'method': request.method,
+                               'path': request.path,
+                               'status': response.status_code,
+                               'latency_ms': round(
+                                   (time.perf_counter() - started) * 1000, 3)
+                               if started else None,
+                               'queries': g.get('queries', 0),
+                               'auth': g.get('auth'),
+                               'sub': g.get('sub')
+                           }})
+        return response
+
+    return handler
@@ -0,0 +1,71 @@
+import threading
+from functools import wraps
+
+from flask import Response, make_response, request
+
+from backend.database.shards import current_shard
+
+
+class _Call:
+    """A view call in flight that other requests can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces identical concurrent GET requests in this process.
+    The first request for a path (per tenant shard) runs the view, requests
+    for the same path arriving meanwhile wait for it and get a copy of its
+    response, so only one database query runs per burst. Apply below
+    requires_auth so every caller is still authorized
+    EXAMPLE
+        single_flight = SingleFlight()
+
+        @app.route('/rented')
+        @requires_auth('get:rented')
+        @single_flight.coalesce
+        def get_rented_plants(jwt):
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def coalesce(self, f):
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+
+            key = (current_shard(), request.full_path)
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = _Call()
+
+            if not leader:
+                call.done.wait()
+                if call.error is not None:
+                    raise call.error
+                body, status, headers = call.response
+                return Response(body, status=status, headers=headers)
+
+            try:
+                response = make_response(f(*args, **kwargs))
+                call.response = (response.get_data(), response.status_code,
+                                 list(response.headers))
+                return response
+            except Exception as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+
+        return wrapper
@@ -0,0 +1,78 @@
+import gzip
+import os
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSIBLE_MIMETYPES = ('application/json',)
+# Content codings this server can produce, best first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate_encoding(accept_encoding):
+    """Picks the best content coding the client accepts
+    :param accept_encoding: value of the Accept-Encoding request header
+    :return: 'br', 'gzip' or None for identity
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for coding in ENCODINGS:
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return None
+
+
+def compress(body, encoding, level=6):
+    """Compresses the body with the given content coding
+    :param body: bytes to compress
+    :param encoding: 'br' or 'gzip'
+    :param level: gzip level 1-9, mapped onto the brotli quality scale
+    :return: compressed bytes
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(11, level + 2))
+    return gzip.compress(body, compresslevel=level)
+
+
+def setup_compression(app, min_size=COMPRESSION_MIN_SIZE):
+    """Compresses JSON responses larger than min_size bytes for clients that
+    send a matching Accept-Encoding. Responses that are already encoded,
+    i.e. served from the response cache, are left untouched
+    """
+
+    @app.after_request
+    def compress_response(response):
+        response.vary.add('Accept-Encoding')
+
+        if response.status_code != 200 or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers \
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+        if encoding:
+            response.set_data(compress(body, encoding))
+            response.headers['Content-Encoding'] = encoding
+
+        return response
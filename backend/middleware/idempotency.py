@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, abort, make_response, request
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from backend.database.models import IdempotencyKey, db
+from backend.database.shards import current_shard
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 60))
+# Seconds between purges of the expired keys, per worker
+IDEMPOTENCY_PURGE_INTERVAL = int(
+    os.environ.get('IDEMPOTENCY_PURGE_INTERVAL', 10 * 60))
+
+# Response headers recorded with the body and sent again on replay
+REPLAYED_HEADERS = ('ETag', 'Location')
+
+_purged_at = {}
+
+
+def _digest(*parts):
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else str(part).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def _expired(record):
+    """A recorded response past its TTL or a claim whose request died"""
+    age = datetime.utcnow() - record.created_at
+    if record.status_code is None:
+        return age > timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)
+    return age > timedelta(seconds=IDEMPOTENCY_TTL)
+
+
+def purge_expired():
+    """Deletes the recorded responses past IDEMPOTENCY_TTL and the claims
+    whose request died
+    :return: number of keys deleted
+    """
+    now = datetime.utcnow()
+    recorded_before = now - timedelta(seconds=IDEMPOTENCY_TTL)
+    claimed_before = now - timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)
+    deleted = IdempotencyKey.query.filter(or_(
+        and_(IdempotencyKey.status_code.isnot(None),
+             IdempotencyKey.created_at < recorded_before),
+        and_(IdempotencyKey.status_code.is_(None),
+             IdempotencyKey.created_at < claimed_before)
+    )).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def _purge_due():
+    """Purges the expired keys of the current shard at most every
+    IDEMPOTENCY_PURGE_INTERVAL seconds, keys are otherwise only dropped
+    when the same key comes back
+    """
+    shard = current_shard()
+    if time.monotonic() - _purged_at.get(shard, float('-inf')) < \
+            IDEMPOTENCY_PURGE_INTERVAL:
+        return
+    _purged_at[shard] = time.monotonic()
+    purge_expired()
+
+
+def _claim(key, fingerprint):
+    """Claims the key for this request
+    :return: None when claimed, otherwise the existing IdempotencyKey
+    """
+    _purge_due()
+    record = IdempotencyKey.query.get(key)
+    if record is not None and _expired(record):
+        record.delete()
+        record = None
+
+    if record is None:
+        try:
+            IdempotencyKey(id=key, fingerprint=fingerprint).insert()
+            return None
+        except IntegrityError:
+            # Another worker claimed the same key first
+            db.session.rollback()
+            record = IdempotencyKey.query.get(key)
+
+    return record
+
+
+def _release(key):
+    """Drops the claim on the key after a failed write"""
+    db.session.rollback()
+    record = IdempotencyKey.query.get(key)
+    if record is not None:
+        record.delete()
+
+
+def idempotent(f):
+    """Decorator for write routes honouring the Idempotency-Key header.
+    The first request with a key runs the route and records its successful
+    response; repeats with the same key and body get the recorded response
+    without running the write again. Keys are scoped to the JWT subject,
+    so it must be applied below requires_auth
+    EXAMPLE
+        @app.route('/add', methods=['POST'])
+        @requires_auth('post:plants')
+        @idempotent
+        def add_plant(jwt):
+    """
+
+    @wraps(f)
+    def wrapper(jwt, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            return f(jwt, *args, **kwargs)
+
+        key = _digest(jwt.get('sub'), idempotency_key)
+        fingerprint = _digest(request.method, request.path,
+                              request.get_data())
+
+        record = _claim(key, fingerprint)
+        if record is not None:
+            if record.fingerprint != fingerprint:
+                # Same key reused for a different request
+                abort(422)
+            if record.status_code is None:
+                # The original request is still running
+                abort(409)
+
+            response = Response(record.body, status=record.status_code,
+                                mimetype='application/json',
+                                headers=json.loads(record.headers or '[]'))
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(jwt, *args, **kwargs))
+        except Exception:
+            # Failed writes are not recorded so the client can retry
+            _release(key)
+            raise
+
+        if 200 <= response.status_code < 300:
+            record = IdempotencyKey.query.get(key)
+            record.status_code = response.status_code
+            record.body = response.get_data(as_text=True)
+            record.headers = json.dumps([
+                [name, value] for name, value in response.headers
+                if name in REPLAYED_HEADERS])
+            record.update()
+        else:
+            _release(key)
+
+        return response
+
+    return wrapper
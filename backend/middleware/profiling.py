@@ -0,0 +1,143 @@
+import cProfile
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from uuid import uuid4
+
+from backend.auth.auth import check_permissions, verify_decode_jwt
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_SAMPLE_RATE = int(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.005))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', 100))
+PROFILE_PERMISSION = 'profile:requests'
+
+
+class StackSampler:
+    """Samples the stack of one thread from a background thread and counts
+    the collapsed stacks, the input format of flamegraph.pl and speedscope
+    """
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.running = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while self.running.is_set():
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:'
+                             f'{code.co_name}:{frame.f_lineno}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def start(self):
+        self.running.set()
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.thread.join()
+
+    def dump(self, path):
+        with open(path, 'w') as folded:
+            for stack, count in self.stacks.items():
+                folded.write(f'{stack} {count}\n')
+
+
+class ProfilerMiddleware:
+    """WSGI middleware profiling single requests on demand.
+    A request is profiled when it sends an 'X-Profile: 1' header with a JWT
+    holding the 'profile:requests' permission, or when it is picked by
+    sampling 1 in PROFILE_SAMPLE_RATE requests. The profile covers the whole
+    request (auth, SQLAlchemy and jsonify) and is written to PROFILE_DIR,
+    keeping the newest PROFILE_KEEP files
+    """
+
+    def __init__(self, wsgi_app, directory, mode=PROFILE_MODE,
+                 sample_rate=PROFILE_SAMPLE_RATE, keep=PROFILE_KEEP):
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.keep = keep
+        os.makedirs(directory, exist_ok=True)
+
+    def _requested(self, environ):
+        """True for a profile header sent with a permitted JWT"""
+        if environ.get('HTTP_X_PROFILE') != '1':
+            return False
+
+        parts = environ.get('HTTP_AUTHORIZATION', '').split()
+        if len(parts) != 2 or parts[0].lower() != 'bearer':
+            return False
+
+        try:
+            return check_permissions(PROFILE_PERMISSION,
+                                     verify_decode_jwt(parts[1]))
+        except Exception:
+            return False
+
+    def _sampled(self):
+        return self.sample_rate > 0 and \
+            random.randrange(self.sample_rate) == 0
+
+    def __call__(self, environ, start_response):
+        if not (self._sampled() or self._requested(environ)):
+            return self.wsgi_app(environ, start_response)
+
+        started = time.perf_counter()
+        if self.mode == 'cprofile':
+            profiler = cProfile.Profile()
+            response = profiler.runcall(self.wsgi_app, environ,
+                                        start_response)
+        else:
+            profiler = StackSampler(threading.get_ident())
+            profiler.start()
+            try:
+                response = self.wsgi_app(environ, start_response)
+            finally:
+                profiler.stop()
+
+        self._save(profiler, environ, time.perf_counter() - started)
+        return response
+
+    def _save(self, profiler, environ, elapsed):
+        """Writes the profile and drops the oldest ones beyond keep"""
+        path = re.sub(r'[^A-Za-z0-9]+', '.',
+                      environ.get('PATH_INFO', '/')).strip('.') or 'root'
+        name = f'{time.strftime("%Y%m%dT%H%M%S")}-' \
+               f'{environ.get("REQUEST_METHOD", "GET")}.{path}-' \
+               f'{elapsed * 1000:.0f}ms-{uuid4().hex[:8]}'
+
+        if isinstance(profiler, cProfile.Profile):
+            profiler.dump_stats(os.path.join(self.directory, name + '.prof'))
+        else:
+            profiler.dump(os.path.join(self.directory, name + '.folded'))
+
+        profiles = sorted((entry for entry in os.scandir(self.directory)
+                           if entry.name.endswith(('.prof', '.folded'))),
+                          key=lambda entry: entry.stat().st_mtime)
+        for entry in profiles[:-self.keep]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+def setup_profiling(app, directory=PROFILE_DIR):
+    """Wraps the app with the ProfilerMiddleware when a directory is set"""
+    if directory:
+        app.wsgi_app = ProfilerMiddleware(app.wsgi_app, directory)
@@ -1,11 +1,43 @@
+import gzip
+import logging
 import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import json
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
 
-from backend.app import app
+from flask import jsonify, request
+
+from backend.app import app, catalog_cache, invoice_cache, rate_limited
+from backend.auth.keys import LocalIssuer, RemoteJWKS, get_key_provider, \
+    set_key_provider
+from backend.auth.ratelimit import MemoryBucketStore, RateLimit, \
+    RateLimitError, get_store
+from backend.cache.response import ResponseCache
+from backend.cache.shared import SharedCache
 from backend.load_db import go
-from backend.database.models import setup_db, db_drop_and_create_all
+from backend.middleware.access_log import AsyncLogHandler, JsonFormatter, \
+    access_logger, error_logger
+from backend.middleware.coalesce import SingleFlight
+from backend.middleware.idempotency import purge_expired
+from backend.middleware.profiling import ProfilerMiddleware
+from datetime import datetime
+
+from backend.database.archive import archive_closed_rentals, \
+    archive_every_shard
+from backend.database.models import setup_db, db_drop_and_create_all, \
+    Catalog, IdempotencyKey, Renter, Rented, RentedArchive, Report
+from backend.database.shards import setup_shards, shard_for, use_shard
+
+
+RENTER_PERMISSIONS = ['get:invoice', 'get:rented', 'get:renters']
+OWNER_PERMISSIONS = RENTER_PERMISSIONS + ['post:plants', 'patch:plants',
+                                          'delete:plants', 'post:renters',
+                                          'get:events']
 
 
 class PlantRentalTestCase(unittest.TestCase):
@@ -15,6 +47,14 @@ class PlantRentalTestCase(unittest.TestCase):
         """Define variables for test and initialize app"""
         self.renter_token = os.environ.get('RENTER_TOKEN')
         self.owner_token = os.environ.get('OWNER_TOKEN')
+
+        if not self.renter_token or not self.owner_token:
+            # No Auth0 tokens given, run offline with locally minted ones
+            issuer = LocalIssuer(secret='plants4rent-test')
+            set_key_provider(issuer)
+            self.renter_token = issuer.mint('auth0|renter',
+                                            RENTER_PERMISSIONS)
+            self.owner_token = issuer.mint('auth0|owner', OWNER_PERMISSIONS)
         self.database_name = os.environ.get('DATABASE_TEST_NAME')
         self.database_path = os.environ.get('DATABASE_TEST_PATH')
 
@@ -38,6 +78,11 @@ class PlantRentalTestCase(unittest.TestCase):
             db_drop_and_create_all()
             go()
 
+        catalog_cache.clear()
+        invoice_cache.clear()
+        # Every test starts with full rate limit buckets
+        get_store().clear()
+
     def tearDown(self):
         """Executed after reach test"""
         pass
@@ -58,6 +103,21 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('message', reply)
         self.assertEqual(len(reply['plants']), 5)
 
+    def test_get_plants_fields(self):
+        response = self.client.get('/plants?fields=name,price')
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        for plant in reply['plants']:
+            self.assertEqual(set(plant), {'id', 'name', 'price'})
+
+    def test_get_plants_by_id_fields(self):
+        response = self.client.get('/plants/1?fields=quantity')
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        self.assertEqual(set(reply['plants']), {'id', 'quantity'})
+
     def test_get_renter_invoice(self):
         response = self.client.get('/invoice/1', headers=self.renter_headers)
         self.assertEqual(response.status_code, 200)
@@ -67,6 +127,83 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('success', reply)
         self.assertIn('total', reply)
 
+    def test_get_renter_invoice_current(self):
+        initial = json.loads(self.client.get(
+            '/invoice/4', headers=self.renter_headers).data)
+        with self.app.app_context():
+            Rented(plant_id=1, renter_id=4,
+                   started_at=datetime(2020, 1, 1)).insert()
+            Rented(plant_id=2, renter_id=4, started_at=datetime(2020, 1, 1),
+                   ended_at=datetime(2020, 1, 31)).insert()
+        before = json.loads(self.client.get(
+            '/invoice/4', headers=self.renter_headers).data)
+
+        # Archiving the ended rental leaves the current invoice alone
+        with self.app.app_context():
+            archive_closed_rentals(datetime(2020, 6, 1))
+        after = json.loads(self.client.get(
+            '/invoice/4', headers=self.renter_headers).data)
+
+        self.assertAlmostEqual(before['total'], initial['total'] + 25.97)
+        self.assertEqual(after['invoice'], before['invoice'])
+        self.assertEqual(after['total'], before['total'])
+
+    def test_get_renter_invoice_period(self):
+        with self.app.app_context():
+            Rented(plant_id=1, renter_id=1, started_at=datetime(2020, 1, 1),
+                   ended_at=datetime(2020, 1, 31)).insert()
+            Rented(plant_id=2, renter_id=1, started_at=datetime(2020, 3, 1),
+                   ended_at=datetime(2020, 3, 31)).insert()
+            self.assertEqual(archive_closed_rentals(datetime(2020, 6, 1)), 2)
+            self.assertEqual(RentedArchive.query.count(), 2)
+
+        response = self.client.get('/invoice/1?from=2020-01-01&to=2020-02-01',
+                                   headers=self.renter_headers)
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        self.assertEqual(reply['invoice'], {
+            'Rose': {'count': 1, 'price': 25.97}
+        })
+        self.assertEqual(reply['total'], 25.97)
+
+    def test_get_renter_invoice_period_utc(self):
+        with self.app.app_context():
+            Rented(plant_id=1, renter_id=4, started_at=datetime(2020, 1, 1),
+                   ended_at=datetime(2020, 1, 1, 12)).insert()
+
+        for period in ('from=2020-01-01T00:00:00Z&to=2020-01-02T00:00:00Z',
+                       'from=2020-01-01T10:00:00%2B10:00'
+                       '&to=2020-01-01T11:00:00%2B10:00'):
+            response = self.client.get(f'/invoice/4?{period}',
+                                       headers=self.renter_headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['total'], 25.97)
+
+    def test_get_renter_invoice_rented_price(self):
+        period = '/invoice/4?from=2020-01-01&to=2020-02-01'
+        with self.app.app_context():
+            Rented(plant_id=1, renter_id=4, started_at=datetime(2020, 1, 1),
+                   ended_at=datetime(2020, 1, 2)).insert()
+        self.assertEqual(json.loads(self.client.get(
+            period, headers=self.renter_headers).data)['total'], 25.97)
+
+        # A price change leaves past rentals, and the cached invoice, alone
+        self.client.patch('/plants/1', headers=self.json_headers,
+                          json={'price': 30.0})
+        self.assertEqual(json.loads(self.client.get(
+            period, headers=self.renter_headers).data)['total'], 25.97)
+
+        # A new rental is invoiced at the new price
+        with self.app.app_context():
+            Rented(plant_id=1, renter_id=4, started_at=datetime(2020, 1, 3),
+                   ended_at=datetime(2020, 1, 4)).insert()
+        reply = json.loads(self.client.get(
+            period, headers=self.renter_headers).data)
+        self.assertEqual(reply['invoice'], {
+            'Rose': {'count': 2, 'price': 55.97}
+        })
+
     def test_get_rented_plants(self):
         response = self.client.get('/rented', headers=self.renter_headers)
         self.assertEqual(response.status_code, 200)
@@ -84,6 +221,79 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('success', reply)
         self.assertIn('data', reply)
 
+    def test_get_renters_fields(self):
+        response = self.client.get('/renters?fields=name,state',
+                                   headers=self.owner_headers)
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        for renter in reply['data']:
+            self.assertEqual(set(renter), {'id', 'name', 'state'})
+
+    def test_get_renters_lookup(self):
+        response = self.client.get('/renters?state=VA',
+                                   headers=self.owner_headers)
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        self.assertEqual([renter['name'] for renter in reply['data']],
+                         ['Will Constant'])
+
+        response = self.client.get('/renters?name=Julie%20Ray',
+                                   headers=self.owner_headers)
+        reply = json.loads(response.data)
+        self.assertEqual(reply['data'][0]['state'], 'CA')
+
+    def test_get_renters_page(self):
+        response = self.client.get('/renters?limit=2&after=1&fields=name',
+                                   headers=self.owner_headers)
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        self.assertEqual([renter['id'] for renter in reply['data']], [2, 3])
+        self.assertEqual(reply['next'], 3)
+
+    def test_get_renters_default_page(self):
+        with mock.patch('backend.app.MAX_PAGE_SIZE', 2):
+            first = json.loads(self.client.get(
+                '/renters', headers=self.owner_headers).data)
+            last = json.loads(self.client.get(
+                '/renters?after=100', headers=self.owner_headers).data)
+
+        self.assertEqual([renter['id'] for renter in first['data']], [1, 2])
+        self.assertEqual(first['next'], 2)
+        self.assertIsNone(last['next'])
+
+    def test_get_renter_by_id(self):
+        response = self.client.get('/renters/1', headers=self.owner_headers)
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        self.assertIn('success', reply)
+        self.assertEqual(len(reply['renter']), 5)
+
+    def test_add_renters(self):
+        renters = [
+            {'name': 'Ada Fern', 'address': '1 Moss Rd', 'city': 'Reno',
+             'state': 'NV'},
+            {'name': 'Julie Ray', 'address': '1234 Ray Port Ln',
+             'city': 'Los Angeles', 'state': 'CA'},
+            {'name': 'Ada Fern', 'address': '2 Moss Rd', 'city': 'Reno',
+             'state': 'NV'},
+        ]
+        response = self.client.post('/renters/bulk', headers=self.json_headers,
+                                    json={'renters': renters})
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        self.assertEqual(reply['created'], 1)
+        self.assertEqual(reply['conflicts'], ['Julie Ray', 'Ada Fern'])
+
+        response = self.client.get('/renters?name=Ada%20Fern',
+                                   headers=self.owner_headers)
+        self.assertEqual(json.loads(response.data)['data'][0]['address'],
+                         '1 Moss Rd')
+
     def test_add_plant(self):
         plant = {
             "name": "Thyme",
@@ -114,6 +324,26 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('success', reply)
         self.assertIn('plant', reply)
 
+    def test_update_plant_entry_partial(self):
+        response = self.client.patch('/plants/2', headers=self.json_headers,
+                                     json={'price': 6.97})
+        self.assertEqual(response.status_code, 200)
+
+        reply = json.loads(response.data)
+        self.assertEqual(reply['plant']['price'], 6.97)
+        self.assertEqual(reply['plant']['name'], 'Golden Pathos')
+
+    def test_update_plant_entry_if_match(self):
+        etag = self.client.get('/plants/2').headers['ETag']
+
+        headers = dict(self.json_headers, **{'If-Match': etag})
+        response = self.client.patch('/plants/2', headers=headers,
+                                     json={'quantity': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(self.client.get('/plants/2').headers['ETag'],
+                         response.headers['ETag'])
+
     def test_delete_plant(self):
         response = self.client.delete('/plants/4', headers=self.owner_headers)
         self.assertEqual(response.status_code, 200)
@@ -122,10 +352,292 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('success', reply)
         self.assertIn('id', reply)
 
+    def test_get_plants_gzip(self):
+        plant = {
+            "name": "Thyme",
+            "description": "Makes a lovely tea for studying. " * 64,
+            "quantity": 40,
+            "price": 4.97
+        }
+        self.client.post('/add', headers=self.json_headers, json=plant)
+
+        plain = self.client.get('/plants')
+        response = self.client.get('/plants',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertLess(len(response.data), len(plain.data))
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+    def test_get_plants_cache_cleared_on_add(self):
+        before = json.loads(self.client.get('/plants').data)
+        plant = {
+            "name": "Thyme",
+            "description": "Makes a lovely tea for studying",
+            "quantity": 40,
+            "price": 4.97
+        }
+        self.client.post('/add', headers=self.json_headers, json=plant)
+        after = json.loads(self.client.get('/plants').data)
+
+        self.assertEqual(len(after['plants']), len(before['plants']) + 1)
+
+    def test_get_plants_cache_ignores_other_params(self):
+        self.client.get('/plants?junk=1')
+        self.client.get('/plants?junk=2')
+        self.client.get('/plants?fields=price,name')
+        self.client.get('/plants?fields=name,%20price')
+
+        self.assertEqual(len(catalog_cache.entries), 2)
+
+    def test_get_plants_cache_versioned_by_catalog_writes(self):
+        self.client.get('/plants/2')
+        # A write made by another worker does not clear this worker's cache
+        with app.app_context():
+            Catalog.update_fields(2, {'price': 1.23})
+
+        reply = json.loads(self.client.get('/plants/2').data)
+        self.assertEqual(reply['plants']['price'], 1.23)
+
+    def wait_for_report(self, location, headers):
+        for _ in range(100):
+            reply = json.loads(self.client.get(location, headers=headers).data)
+            if reply['report']['status'] in ('done', 'failed'):
+                return reply
+            time.sleep(0.05)
+        self.fail('report did not finish')
+
+    def test_queue_rented_report(self):
+        response = self.client.post('/reports/rented',
+                                    headers=self.owner_headers)
+        self.assertEqual(response.status_code, 202)
+
+        reply = json.loads(response.data)
+        self.assertIn('report', reply)
+        self.assertTrue(response.headers['Location'].endswith(
+            '/reports/' + reply['report']['id']))
+
+        reply = self.wait_for_report(response.headers['Location'],
+                                     self.owner_headers)
+        rented = json.loads(self.client.get('/rented',
+                                            headers=self.owner_headers).data)
+        self.assertEqual(reply['report']['status'], 'done')
+        self.assertEqual(reply['report']['result']['data'], rented['data'])
+
+    def test_queue_invoice_report(self):
+        response = self.client.post('/reports/invoice/1',
+                                    headers=self.renter_headers)
+        self.assertEqual(response.status_code, 202)
+
+        reply = self.wait_for_report(response.headers['Location'],
+                                     self.renter_headers)
+        self.assertEqual(reply['report']['status'], 'done')
+        self.assertIn('invoice', reply['report']['result'])
+        self.assertIn('total', reply['report']['result'])
+
+    def test_add_plant_idempotency_key(self):
+        plant = {
+            "name": "Thyme",
+            "description": "Makes a lovely tea for studying",
+            "quantity": 40,
+            "price": 4.97
+        }
+        headers = dict(self.json_headers, **{'Idempotency-Key': 'add-thyme'})
+
+        first = self.client.post('/add', headers=headers, json=plant)
+        retry = self.client.post('/add', headers=headers, json=plant)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(json.loads(retry.data), json.loads(first.data))
+
+        # Without the key the duplicate name is still rejected
+        response = self.client.post('/add', headers=self.json_headers,
+                                    json=plant)
+        self.assertEqual(response.status_code, 422)
+
+    def test_replay_keeps_headers(self):
+        headers = dict(self.json_headers, **{'Idempotency-Key': 'price'})
+        first = self.client.patch('/plants/2', headers=headers,
+                                  json={'price': 6.97})
+        retry = self.client.patch('/plants/2', headers=headers,
+                                  json={'price': 6.97})
+        self.assertEqual(retry.headers['ETag'], first.headers['ETag'])
+
+        headers = dict(self.owner_headers, **{'Idempotency-Key': 'report'})
+        first = self.client.post('/reports/rented', headers=headers)
+        retry = self.client.post('/reports/rented', headers=headers)
+        self.assertEqual(retry.status_code, 202)
+        self.assertEqual(retry.headers['Location'], first.headers['Location'])
+        self.wait_for_report(first.headers['Location'], self.owner_headers)
+
+    def test_expired_idempotency_keys_purged(self):
+        with self.app.app_context():
+            IdempotencyKey(id='old', fingerprint='f', status_code=200,
+                           body='{}', created_at=datetime(2020, 1, 1)).insert()
+            IdempotencyKey(id='new', fingerprint='f', status_code=200,
+                           body='{}').insert()
+
+            self.assertEqual(purge_expired(), 1)
+            self.assertEqual([record.id for record in
+                              IdempotencyKey.query.all()], ['new'])
+
+    def get_events(self, after, **params):
+        response = self.client.get('/events', headers=self.owner_headers,
+                                   query_string=dict(after=after, **params))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+
+    def test_get_events(self):
+        last = self.get_events(0, limit=1000)['last']
+        self.assertGreater(last, 0)
+
+        plant = {
+            "name": "Thyme",
+            "description": "Makes a lovely tea for studying",
+            "quantity": 40,
+            "price": 4.97
+        }
+        plant_id = json.loads(self.client.post(
+            '/add', headers=self.json_headers, json=plant).data)['plant']['id']
+        self.client.patch(f'/plants/{plant_id}', headers=self.json_headers,
+                          json={'price': 5.97})
+        self.client.delete(f'/plants/{plant_id}', headers=self.owner_headers)
+
+        reply = self.get_events(last)
+        self.assertEqual([(change['entity'], change['action'])
+                          for change in reply['events']],
+                         [('plant', 'insert'), ('plant', 'update'),
+                          ('plant', 'delete')])
+        self.assertEqual(reply['events'][1]['data']['price'], 5.97)
+        self.assertEqual(reply['last'], reply['events'][-1]['seq'])
+        self.assertEqual(self.get_events(reply['last'])['events'], [])
+
+    def test_get_events_long_poll(self):
+        last = self.get_events(0, limit=1000)['last']
+
+        def rent():
+            time.sleep(0.2)
+            with app.app_context():
+                Rented(plant_id=1, renter_id=1).insert()
+
+        writer = threading.Thread(target=rent)
+        writer.start()
+        started = time.monotonic()
+        reply = self.get_events(last, wait=10)
+        writer.join()
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual(reply['events'][0]['entity'], 'rental')
+        self.assertEqual(reply['events'][0]['action'], 'insert')
+
+    def test_get_events_stream(self):
+        headers = dict(self.owner_headers, Accept='text/event-stream',
+                       **{'Last-Event-ID': '0'})
+        response = self.client.get('/events', headers=headers,
+                                   buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+
+        messages = iter(response.response)
+        self.assertTrue(next(messages).startswith(b'retry:'))
+        self.assertTrue(next(messages).startswith(b'id: 1\n'))
+        response.close()
+
+    def profile_requests(self, **kwargs):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(setattr, self.app, 'wsgi_app', self.app.wsgi_app)
+        self.app.wsgi_app = ProfilerMiddleware(self.app.wsgi_app, directory,
+                                               **kwargs)
+        return directory
+
+    def test_profile_requested_by_header(self):
+        directory = self.profile_requests()
+        issuer = LocalIssuer(secret='plants4rent-test')
+        self.addCleanup(set_key_provider, get_key_provider())
+        set_key_provider(issuer)
+        token = issuer.mint('auth0|owner', ['profile:requests'])
+
+        self.client.get('/plants', headers={'X-Profile': '1'})
+        self.assertEqual(os.listdir(directory), [])
+
+        response = self.client.get('/plants', headers={
+            'X-Profile': '1', 'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(os.listdir(directory)), 1)
+        self.assertTrue(os.listdir(directory)[0].endswith('.folded'))
+
+    def test_profile_sampled_with_retention(self):
+        directory = self.profile_requests(mode='cprofile', sample_rate=1,
+                                          keep=2)
+        for _ in range(3):
+            self.client.get('/plants')
+
+        profiles = os.listdir(directory)
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(name.endswith('.prof') for name in profiles))
+
     # ----------------------------------------------------------------------
     #  Error Checks
     # ----------------------------------------------------------------------
 
+    def capture_logs(self, logger):
+        """Records the log records the logger emits during the test"""
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        return records
+
+    def test_access_log(self):
+        records = self.capture_logs(access_logger)
+        self.client.get('/rented', headers=self.renter_headers)
+
+        fields = records[-1].fields
+        self.assertEqual(fields['route'], '/rented')
+        self.assertEqual(fields['status'], 200)
+        self.assertEqual(fields['auth'], 'ok')
+        self.assertEqual(fields['sub'], 'auth0|renter')
+        self.assertGreater(fields['queries'], 0)
+        self.assertGreaterEqual(fields['latency_ms'], 0)
+
+        entry = json.loads(JsonFormatter().format(records[-1]))
+        self.assertEqual(entry['logger'], 'plants4rent.access')
+        self.assertEqual(entry['status'], 200)
+
+    def test_access_log_sampling(self):
+        records = self.capture_logs(access_logger)
+        app.config['LOG_SAMPLE_RATES'] = {'/plants': 0.0}
+        self.addCleanup(app.config.__setitem__, 'LOG_SAMPLE_RATES', {})
+
+        self.client.get('/plants')
+        self.client.get('/rented')
+        self.assertEqual([record.fields['route'] for record in records],
+                         ['/rented'])
+
+        # Failed requests are always logged
+        self.client.get('/plants?fields=color')
+        self.assertEqual(records[-1].fields['status'], 422)
+
+    def test_access_log_auth_outcome(self):
+        records = self.capture_logs(access_logger)
+        self.client.get('/rented')
+
+        self.assertEqual(records[-1].fields['status'], 401)
+        self.assertEqual(records[-1].fields['auth'], 'authorization_header_'
+                                                     'missing')
+
+    def test_error_log(self):
+        records = self.capture_logs(error_logger)
+        response = self.client.patch('/plants/2', headers=self.json_headers,
+                                     json={'name': 'Rose'})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(records[-1].fields['route'], '/plants/<int:plant_id>')
+        self.assertEqual(records[-1].fields['sub'], 'auth0|owner')
+        self.assertIsNotNone(records[-1].exc_info)
+
     def test_404_get_plants_by_id(self):
         response = self.client.get('/plants/100000000000000000')
         self.assertEqual(response.status_code, 404)
@@ -135,6 +647,31 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('success', reply)
         self.assertIn('message', reply)
 
+    def test_422_get_plants_unknown_field(self):
+        response = self.client.get('/plants?fields=name,secret')
+        self.assertEqual(response.status_code, 422)
+
+        reply = json.loads(response.data)
+        self.assertIn('error', reply)
+        self.assertIn('success', reply)
+        self.assertIn('message', reply)
+
+    def test_404_get_renter_by_id(self):
+        response = self.client.get('/renters/1000',
+                                   headers=self.owner_headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_422_add_renters(self):
+        response = self.client.post('/renters/bulk', headers=self.json_headers,
+                                    json={'renters': [{'name': 'Ada Fern'}]})
+        self.assertEqual(response.status_code, 422)
+
+    def test_401_add_renters(self):
+        response = self.client.post('/renters/bulk',
+                                    headers=self.renter_headers,
+                                    json={'renters': []})
+        self.assertEqual(response.status_code, 401)
+
     def test_401_get_renter_invoice(self):
         response = self.client.get('/invoice/1')
         self.assertEqual(response.status_code, 401)
@@ -143,6 +680,47 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('code', reply)
         self.assertIn('description', reply)
 
+    def test_422_get_renter_invoice_period(self):
+        response = self.client.get('/invoice/1?from=yesterday',
+                                   headers=self.renter_headers)
+        self.assertEqual(response.status_code, 422)
+
+    def test_401_get_renter_invoice_expired_token(self):
+        issuer = LocalIssuer(secret='plants4rent-test')
+        self.addCleanup(set_key_provider, get_key_provider())
+        set_key_provider(issuer)
+        token = issuer.mint('auth0|renter', RENTER_PERMISSIONS, expires_in=-60)
+
+        response = self.client.get('/invoice/1', headers={
+            'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 401)
+
+    def test_local_issuer_audience(self):
+        issuer = LocalIssuer(secret='plants4rent-test', audience='loadTest')
+        self.addCleanup(set_key_provider, get_key_provider())
+        set_key_provider(issuer)
+
+        token = issuer.mint('auth0|renter', RENTER_PERMISSIONS)
+        response = self.client.get('/invoice/1', headers={
+            'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 200)
+
+        token = LocalIssuer(secret='plants4rent-test', audience='other') \
+            .mint('auth0|renter', RENTER_PERMISSIONS)
+        response = self.client.get('/invoice/1', headers={
+            'Authorization': 'Bearer ' + token})
+        self.assertEqual(response.status_code, 401)
+
+    def test_local_provider_needs_a_secret(self):
+        self.addCleanup(set_key_provider, get_key_provider())
+        set_key_provider(None)
+
+        with mock.patch.multiple('backend.auth.keys',
+                                 AUTH_KEY_PROVIDER='local', AUTH_SECRET=None,
+                                 AUTH_PRIVATE_KEY_FILE=None):
+            with self.assertRaises(ValueError):
+                get_key_provider()
+
     def test_401_get_rented_plants(self):
         response = self.client.get('/rented', )
         self.assertEqual(response.status_code, 401)
@@ -187,6 +765,106 @@ class PlantRentalTestCase(unittest.TestCase):
         self.assertIn('code', reply)
         self.assertIn('description', reply)
 
+    def test_401_queue_rented_report(self):
+        response = self.client.post('/reports/rented')
+        self.assertEqual(response.status_code, 401)
+
+        reply = json.loads(response.data)
+        self.assertIn('code', reply)
+        self.assertIn('description', reply)
+
+    def test_get_report_left_by_restarted_worker(self):
+        with app.app_context():
+            report = Report(id='stale', kind='rented', status='running',
+                            permission='get:rented',
+                            created_at=datetime(2020, 1, 1))
+            report.insert()
+
+        reply = json.loads(self.client.get('/reports/stale',
+                                           headers=self.owner_headers).data)
+        self.assertEqual(reply['report']['status'], 'failed')
+        self.assertIsNotNone(reply['report']['finished_at'])
+
+    def test_404_get_report(self):
+        response = self.client.get('/reports/unknown',
+                                   headers=self.owner_headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_422_idempotency_key_reused(self):
+        plant = {
+            "name": "Thyme",
+            "description": "Makes a lovely tea for studying",
+            "quantity": 40,
+            "price": 4.97
+        }
+        headers = dict(self.json_headers, **{'Idempotency-Key': 'add-thyme'})
+        self.client.post('/add', headers=headers, json=plant)
+
+        plant['name'] = 'Rosemary'
+        response = self.client.post('/add', headers=headers, json=plant)
+        self.assertEqual(response.status_code, 422)
+
+    def test_409_update_plant_entry_stale_if_match(self):
+        etag = self.client.get('/plants/2').headers['ETag']
+        self.client.patch('/plants/2', headers=self.json_headers,
+                          json={'quantity': 10})
+
+        headers = dict(self.json_headers, **{'If-Match': etag})
+        response = self.client.patch('/plants/2', headers=headers,
+                                     json={'quantity': 20})
+        self.assertEqual(response.status_code, 409)
+
+        reply = json.loads(response.data)
+        self.assertIn('error', reply)
+        self.assertIn('success', reply)
+        self.assertIn('message', reply)
+
+    def test_409_update_plant_entry_weak_if_match(self):
+        etag = self.client.get('/plants/2').headers['ETag']
+
+        headers = dict(self.json_headers, **{'If-Match': 'W/' + etag})
+        response = self.client.patch('/plants/2', headers=headers,
+                                     json={'quantity': 20})
+        self.assertEqual(response.status_code, 409)
+
+    def test_update_plant_entry_if_match_list(self):
+        etag = self.client.get('/plants/2').headers['ETag']
+
+        headers = dict(self.json_headers,
+                       **{'If-Match': f'"1000", W/"1001", {etag}'})
+        response = self.client.patch('/plants/2', headers=headers,
+                                     json={'quantity': 20})
+        self.assertEqual(response.status_code, 200)
+
+    def test_update_plant_entry_if_match_any(self):
+        headers = dict(self.json_headers, **{'If-Match': '*'})
+        response = self.client.patch('/plants/2', headers=headers,
+                                     json={'quantity': 20})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.patch('/plants/1000', headers=headers,
+                                     json={'quantity': 20})
+        self.assertEqual(response.status_code, 404)
+
+    def test_422_update_plant_entry_not_an_object(self):
+        response = self.client.patch('/plants/2', headers=self.json_headers,
+                                     json=[{'quantity': 20}])
+        self.assertEqual(response.status_code, 422)
+
+    def test_404_update_plant_entry(self):
+        response = self.client.patch('/plants/1000', headers=self.json_headers,
+                                     json={'quantity': 10})
+        self.assertEqual(response.status_code, 404)
+
+    def test_401_get_events(self):
+        response = self.client.get('/events', headers=self.renter_headers)
+        self.assertEqual(response.status_code, 401)
+
+    def test_422_get_events(self):
+        response = self.client.get('/events?wait=3600',
+                                   headers=self.owner_headers)
+        self.assertEqual(response.status_code, 422)
+
     def test_401_delete_plant(self):
         response = self.client.delete('/plants/4')
         self.assertEqual(response.status_code, 401)
@@ -194,3 +872,365 @@ class PlantRentalTestCase(unittest.TestCase):
         reply = json.loads(response.data)
         self.assertIn('code', reply)
         self.assertIn('description', reply)
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """This class represents the rate limit and bulkhead test case"""
+
+    def setUp(self):
+        self.now = 0.0
+        self.store = MemoryBucketStore(clock=lambda: self.now)
+        self.limit = RateLimit(rate=1, burst=2, concurrency=1,
+                               store=self.store)
+
+    def admit(self, subject='auth0|renter', permission='get:rented'):
+        with self.limit.admit(subject, permission):
+            pass
+
+    def test_burst_then_429(self):
+        self.admit()
+        self.admit()
+
+        with self.assertRaises(RateLimitError) as context:
+            self.admit()
+
+        self.assertEqual(context.exception.status_code, 429)
+        self.assertEqual(context.exception.retry_after, 1)
+
+    def test_bucket_refills(self):
+        self.admit()
+        self.admit()
+        self.now += 1.0
+        self.admit()
+
+    def test_least_recently_used_bucket_dropped(self):
+        store = MemoryBucketStore(max_keys=2, clock=lambda: self.now)
+        for key in ('a', 'b', 'a', 'c'):
+            store.take(key, 1, 2)
+
+        self.assertEqual(list(store.buckets), ['a', 'c'])
+
+    def test_buckets_are_per_subject_and_permission(self):
+        self.admit()
+        self.admit()
+        self.admit(subject='auth0|manager')
+        self.admit(permission='get:invoice')
+
+    def test_buckets_are_per_route(self):
+        with app.test_request_context('/rented'):
+            self.admit()
+            self.admit()
+        with app.test_request_context('/reports/rented', method='POST'):
+            self.admit()
+        with app.test_request_context('/rented'):
+            with self.assertRaises(RateLimitError):
+                self.admit()
+
+    def test_bulkhead_rejects_over_concurrency(self):
+        with self.limit.admit('auth0|renter', 'get:rented'):
+            with self.assertRaises(RateLimitError) as context:
+                self.admit(subject='auth0|manager')
+
+        self.assertEqual(context.exception.error['code'], 'too_busy')
+        # The rejected request took no token
+        self.admit(subject='auth0|manager')
+        self.admit(subject='auth0|manager')
+
+    def test_429_has_retry_after(self):
+        with app.app_context():
+            response, status = rate_limited(RateLimitError({
+                'code': 'rate_limited',
+                'description': 'Too many requests. Please, slow down.'
+            }, 429, 3))
+
+        self.assertEqual(status, 429)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        self.assertIn('code', json.loads(response.data))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """This class represents the request coalescing test case"""
+
+    def test_concurrent_gets_run_once(self):
+        single_flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        @single_flight.coalesce
+        def view():
+            calls.append(1)
+            release.wait(5)
+            return jsonify({'success': True})
+
+        replies = []
+
+        def get():
+            with app.test_request_context('/rented'):
+                replies.append(json.loads(view().get_data()))
+
+        threads = [threading.Thread(target=get) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(replies, [{'success': True}] * 5)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """This class represents the response cache test case"""
+
+    def test_least_recently_used_dropped(self):
+        cache = ResponseCache(max_entries=2)
+
+        @cache.cached
+        def view():
+            return jsonify({'path': request.path})
+
+        for path in ('/a', '/b', '/a', '/c'):
+            with app.test_request_context(path):
+                view()
+
+        self.assertEqual([key[1] for key in cache.entries], ['/a', '/c'])
+
+    def test_concurrent_misses_share_one_entry(self):
+        cache = ResponseCache()
+        body = b'{"plants": []}' * 200
+        entries = [cache.set('key', body, 'application/json')
+                   for _ in range(2)]
+
+        with mock.patch('backend.cache.response.compress',
+                        return_value=b'gzipped') as compress:
+            for entry in entries:
+                entry.encoded('gzip')
+
+        self.assertIs(entries[0], entries[1])
+        self.assertEqual(compress.call_count, 1)
+
+
+class AsyncLogHandlerTestCase(unittest.TestCase):
+    """This class represents the non-blocking log handler test case"""
+
+    def test_writes_on_background_thread(self):
+        threads = []
+        target = logging.Handler()
+        target.emit = lambda record: threads.append(
+            threading.current_thread())
+        handler = AsyncLogHandler(target)
+        logger = logging.getLogger('plants4rent.test')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        logger.warning('written later')
+        handler.flush()
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_drops_when_full(self):
+        release = threading.Event()
+        target = logging.Handler()
+        target.emit = lambda record: release.wait(5)
+        handler = AsyncLogHandler(target, maxsize=1)
+
+        started = time.monotonic()
+        for _ in range(5):
+            handler.handle(logging.makeLogRecord({'msg': 'busy',
+                                                   'levelno': logging.INFO}))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertGreaterEqual(handler.dropped, 3)
+
+        release.set()
+        handler.flush()
+
+
+class SharedCacheTestCase(unittest.TestCase):
+    """This class represents the cross worker (shared memory) cache test
+    case. Two caches on the same directory stand in for two workers
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.workers = [SharedCache(self.directory, 'catalog')
+                        for _ in range(2)]
+        self.calls = []
+
+    def get(self, cache):
+        @cache.cached
+        def view():
+            self.calls.append(1)
+            return jsonify({'plants': ['Rose'] * 200})
+
+        with app.test_request_context(
+                '/plants', headers={'Accept-Encoding': 'gzip'}):
+            return view()
+
+    def test_rendered_once_per_host(self):
+        first, second = [ResponseCache(shared=shared)
+                         for shared in self.workers]
+        rendered = self.get(first)
+        mapped = self.get(second)
+
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(mapped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(mapped.get_data(), rendered.get_data())
+
+    def test_compressed_only_when_requested(self):
+        cache = ResponseCache(shared=self.workers[0])
+
+        @cache.cached
+        def view():
+            return jsonify({'plants': ['Rose'] * 200})
+
+        with app.test_request_context('/plants'):
+            view()
+        key = next(iter(cache.entries))
+        meta, sections = self.workers[1].read(key,
+                                              self.workers[1].generation())
+
+        self.assertEqual(set(sections), {'identity'})
+
+    def test_clear_reaches_every_worker(self):
+        first, second = [ResponseCache(shared=shared)
+                         for shared in self.workers]
+        self.get(first)
+        self.get(second)
+        first.clear()
+        self.get(second)
+
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.workers[1].generation(), 1)
+
+    def test_jwks_fetched_once_per_host(self):
+        jwks = {'keys': [{'kid': 'k1', 'kty': 'RSA', 'use': 'sig',
+                          'n': 'n', 'e': 'AQAB'}]}
+        shared = SharedCache(self.directory, 'jwks')
+
+        with mock.patch('backend.auth.keys.urlopen') as urlopen:
+            urlopen.return_value.read.return_value = \
+                json.dumps(jwks).encode()
+            for _ in range(2):
+                key = RemoteJWKS('example.auth0.com', shared=shared) \
+                    .get_key('k1')
+                self.assertEqual(key['kid'], 'k1')
+
+        self.assertEqual(urlopen.call_count, 1)
+
+
+class ShardingTestCase(unittest.TestCase):
+    """This class represents the multi-store (tenant shard) test case"""
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.app = app
+        self.client = self.app.test_client()
+
+        # Every store has its own SQLite file
+        self.shard_map = {
+            'north': 'sqlite:///' + os.path.join(directory, 'north.db'),
+            'south': 'sqlite:///' + os.path.join(directory, 'south.db'),
+        }
+        setup_shards(self.app, self.shard_map)
+        self.addCleanup(setup_shards, self.app, {})
+
+        with self.app.app_context():
+            db_drop_and_create_all()
+        catalog_cache.clear()
+
+        issuer = LocalIssuer(secret='plants4rent-test')
+        self.addCleanup(set_key_provider, get_key_provider())
+        set_key_provider(issuer)
+        self.north_headers = {'Authorization': 'Bearer ' + issuer.mint(
+            'auth0|north', OWNER_PERMISSIONS, tenant='north')}
+        self.south_headers = {'Authorization': 'Bearer ' + issuer.mint(
+            'auth0|south', OWNER_PERMISSIONS, tenant='south')}
+        self.unknown_headers = {'Authorization': 'Bearer ' + issuer.mint(
+            'auth0|west', OWNER_PERMISSIONS, tenant='west')}
+        self.no_tenant_headers = {'Authorization': 'Bearer ' + issuer.mint(
+            'auth0|owner', OWNER_PERMISSIONS)}
+
+    def test_tenants_see_their_own_catalog(self):
+        plant = {
+            "name": "Thyme",
+            "description": "Makes a lovely tea for studying",
+            "quantity": 40,
+            "price": 4.97
+        }
+        response = self.client.post('/add', headers=self.north_headers,
+                                    json=plant)
+        self.assertEqual(response.status_code, 200)
+
+        north = json.loads(self.client.get(
+            '/plants', headers={'X-Tenant': 'north'}).data)
+        south = json.loads(self.client.get(
+            '/plants', headers={'X-Tenant': 'south'}).data)
+        self.assertEqual([p['name'] for p in north['plants']], ['Thyme'])
+        self.assertIsNone(south['plants'])
+
+        # The same name is free in another shard
+        response = self.client.post('/add', headers=self.south_headers,
+                                    json=plant)
+        self.assertEqual(response.status_code, 200)
+
+    def test_one_pool_per_shard(self):
+        self.assertEqual(len(self.app.config['SQLALCHEMY_BINDS']), 2)
+
+    def test_shared_database_rejected(self):
+        shard_map = dict(self.shard_map, east=self.shard_map['north'])
+        with self.assertRaises(ValueError):
+            setup_shards(self.app, shard_map)
+
+    def test_403_missing_tenant(self):
+        response = self.client.get('/events',
+                                   headers=self.no_tenant_headers)
+        self.assertEqual(response.status_code, 403)
+
+        reply = json.loads(response.data)
+        self.assertEqual(reply['code'], 'unknown_tenant')
+
+    def test_default_tenant(self):
+        setup_shards(self.app, self.shard_map, default_tenant='south')
+        plant = {
+            "name": "Thyme",
+            "description": "Makes a lovely tea for studying",
+            "quantity": 40,
+            "price": 4.97
+        }
+        response = self.client.post('/add', headers=self.no_tenant_headers,
+                                    json=plant)
+        self.assertEqual(response.status_code, 200)
+
+        south = json.loads(self.client.get(
+            '/plants', headers={'X-Tenant': 'south'}).data)
+        self.assertEqual([p['name'] for p in south['plants']], ['Thyme'])
+
+    def test_archive_every_shard(self):
+        with self.app.app_context():
+            for tenant in ('north', 'south'):
+                use_shard(shard_for(self.app, tenant))
+                Catalog(name='Rose', description='Red', quantity=1,
+                        price=2.0).insert()
+                Renter(name='Scott', address='1 Main St', city='Oakland',
+                       state='CA').insert()
+                Rented(plant_id=1, renter_id=1,
+                       started_at=datetime(2020, 1, 1),
+                       ended_at=datetime(2020, 1, 2)).insert()
+
+        counts = archive_every_shard(self.app, datetime(2020, 6, 1))
+
+        self.assertEqual(
+            counts, {None: 0, 'shard:0': 1, 'shard:1': 1})
+
+    def test_403_unknown_tenant(self):
+        response = self.client.get('/renters', headers=self.unknown_headers)
+        self.assertEqual(response.status_code, 403)
+
+        reply = json.loads(response.data)
+        self.assertEqual(reply['code'], 'unknown_tenant')
+
+    def test_404_unknown_tenant_header(self):
+        response = self.client.get('/plants', headers={'X-Tenant': 'west'})
+        self.assertEqual(response.status_code, 404)